@@ -0,0 +1,46 @@
+# This example shows using local numpy samplers (simulated annealing, tabu search and
+# annealing on tours) instead of D-Wave's solvers. They don't need qbsolv or access
+# to D-Wave's services.
+
+import sys
+import os
+
+project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(project_dir, 'src'))
+
+from vrp_solvers import FullQuboSolver
+import DWaveSolvers
+from input import *
+
+if __name__ == '__main__':
+
+    graph_path = os.path.join(project_dir, 'graphs/small.csv')
+
+    # Parameters for solve function.
+    only_one_const = 10000000.
+    order_const = 1.
+
+    # Seeds make results reproducible.
+    DWaveSolvers.configure_solver('sa', seed = 0)
+    DWaveSolvers.configure_solver('tabu', seed = 0)
+    DWaveSolvers.configure_solver('permutation', seed = 0)
+
+    for solver_type in ['sa', 'tabu', 'permutation']:
+        print("Solver type : ", solver_type)
+
+        # Reading problem from file.
+        path = os.path.join(project_dir, 'tests/vrp/small_graph1.test')
+        problem = read_full_test(path, graph_path, capacity = False)
+
+        # Solving problem on FullQuboSolver.
+        solver = FullQuboSolver(problem)
+        solution = solver.solve(only_one_const, order_const, solver_type = solver_type)
+
+        # Checking if solution is correct.
+        if solution == None or solution.check() == False:
+            print("Solver hasn't find solution.\n")
+            continue
+
+        print("Solution : ", solution.solution)
+        print("Total cost : ", solution.total_cost())
+        print("\n")
@@ -0,0 +1,48 @@
+# This example measures how time of building QUBO scales with number of vehicles.
+# It doesn't use D-Wave's solvers, so it can be run offline.
+
+import sys
+import os
+import time
+
+project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(project_dir, 'src'))
+
+from vrp_problem import VRPProblem
+import numpy as np
+
+if __name__ == '__main__':
+
+    # Parameters for building qubo.
+    only_one_const = 10000000.
+    order_const = 1.
+    dests_num = 30
+    repeats = 3
+
+    np.random.seed(0)
+    nodes_num = dests_num + 1
+    costs = np.random.randint(1, 100, size=(nodes_num, nodes_num))
+    weights = np.zeros((nodes_num), dtype=int)
+    sources = [0]
+    dests = [i for i in range(1, nodes_num)]
+
+    print("Destinations : ", dests_num)
+    print("Vehicles | Variables | Terms | First build [s] | Next builds [s]")
+
+    for vehicles in range(1, 9):
+        problem = VRPProblem(sources, costs.copy(), [1] * vehicles, dests.copy(), weights.copy())
+
+        # Limits used by AveragePartitionSolver with limit_radius = 1.
+        avg = int(dests_num / vehicles)
+        limits = [(max(avg - 1, 0), min(avg + 1, dests_num)) for _ in range(vehicles)]
+
+        # First build creates structure of qubo, next ones use cached template.
+        times = list()
+        for _ in range(repeats + 1):
+            start = time.perf_counter()
+            qubo = problem.get_qubo_with_both_limits(limits, only_one_const, order_const)
+            rows, _, _ = qubo.get_coo()
+            times.append(time.perf_counter() - start)
+
+        print(vehicles, ' | ', qubo.size(), ' | ', len(rows), ' | ', round(times[0], 4),
+              ' | ', round(min(times[1:]), 4))
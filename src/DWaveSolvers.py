@@ -1,31 +1,124 @@
-# File simplifies communication with DWave solvers. 
+# File simplifies communication with DWave solvers.
+# Solvers' packages are imported only when solver is created, so local samplers
+# can be used without deprecated qbsolv installed.
 
-from dwave_qbsolv import QBSolv
-import hybrid
+from local_samplers import AnnealingSampler, TabuSampler, PermutationSampler
+import threading
 
-# Creates hybrid solver with hardcoded configuration.
-def hybrid_solver():
+# Configuration of solvers, parameters are passed to functions creating solvers.
+# It can be changed with configure_solver.
+solvers_config = {
+    'qpu' : {'tabu_timeout' : 100, 'decomposer_size' : 30, 'rolling_history' : 0.75},
+    'sa' : {'num_reads' : 10, 'num_sweeps' : 200},
+    'tabu' : {'num_reads' : 10},
+    'permutation' : {'num_reads' : 4, 'num_sweeps' : 200},
+}
+
+# Solvers which work directly on VRP problem instead of qubo (see solve_tour).
+tour_solvers = {'permutation'}
+
+# Solvers which accept seed parameter of sampling, seed is ignored for other solvers.
+seeded_solvers = {'cpu', 'sa', 'tabu', 'permutation'}
+
+# Samplers which can't be shared between threads (hybrid workflows keep state of
+# decomposers), every thread gets its own instance of them.
+thread_local_solvers = {'qpu'}
+
+# Solvers created by get_solver. Shared solvers are in _solvers, thread-local in _local
+# together with version of configuration that they were created with.
+_solvers = dict()
+_local = threading.local()
+_versions = dict()
+_lock = threading.Lock()
+
+# Creates hybrid solver.
+# tabu_timeout - timeout of tabu sampler (in miliseconds)
+# decomposer_size - size of subproblems sent to qpu
+# rolling_history - fraction of problem covered by decomposer before it starts again
+def hybrid_solver(tabu_timeout = 100, decomposer_size = 30, rolling_history = 0.75):
+    import hybrid
     workflow = hybrid.Loop(
         hybrid.RacingBranches(
-        hybrid.InterruptableTabuSampler(),
-        hybrid.EnergyImpactDecomposer(size=30, rolling=True, rolling_history=0.75)
+        hybrid.InterruptableTabuSampler(timeout=tabu_timeout),
+        hybrid.EnergyImpactDecomposer(size=decomposer_size, rolling=True,
+                                      rolling_history=rolling_history)
         | hybrid.QPUSubproblemAutoEmbeddingSampler()
         | hybrid.SplatComposer()) | hybrid.ArgMin(), convergence=1)
     return hybrid.HybridSampler(workflow)
 
-# Gets cpu or qpu solver.
-# For qpu hybrid solver is used. For cpu qbsolv.
-def get_solver(solver_type):
+# Creates new solver with configuration from solvers_config.
+# For qpu hybrid solver is used. For cpu qbsolv. For sa and tabu local numpy samplers
+# (simulated annealing and tabu search) from local_samplers.py. For permutation
+# simulated annealing on correct VRP tours.
+def create_solver(solver_type):
+    params = solvers_config.get(solver_type, {})
     solver = None
     if solver_type == 'qpu':
-        solver = hybrid_solver()
+        solver = hybrid_solver(**params)
     if solver_type == 'cpu':
+        from dwave_qbsolv import QBSolv
         solver = QBSolv()
+    if solver_type == 'sa':
+        solver = AnnealingSampler(**params)
+    if solver_type == 'tabu':
+        solver = TabuSampler(**params)
+    if solver_type == 'permutation':
+        solver = PermutationSampler(**params)
     return solver
 
-# Solves qubo on qpu. Returns list of solutions.
-def solve_qubo(qubo, solver_type = 'cpu'):
+# Changes configuration of solver. Solver is created again with new parameters
+# during next get_solver call.
+def configure_solver(solver_type, **params):
+    with _lock:
+        solvers_config.setdefault(solver_type, {}).update(params)
+        _solvers.pop(solver_type, None)
+        _versions[solver_type] = _versions.get(solver_type, 0) + 1
+
+# Gets solver of given type. Solvers are created once and reused by next calls.
+def get_solver(solver_type):
+    if solver_type in thread_local_solvers:
+        version = _versions.get(solver_type, 0)
+        (solver_version, solver) = _local.__dict__.get(solver_type, (None, None))
+        if solver is None or solver_version != version:
+            solver = create_solver(solver_type)
+            setattr(_local, solver_type, (version, solver))
+        return solver
+
+    with _lock:
+        solver = _solvers.get(solver_type)
+        if solver is None:
+            solver = create_solver(solver_type)
+            _solvers[solver_type] = solver
+    return solver
+
+# Solves qubo on qpu. Returns solution with the lowest energy. If samples is given,
+# returns SampleSet with up to samples solutions sorted by energy. Solutions aren't
+# converted to dicts, they can be decoded at once from SampleSet's record.
+# seed - seed of sampler's random generator, makes results reproducible.
+def solve_qubo(qubo, solver_type = 'cpu', samples = None, seed = None):
     sampler = get_solver(solver_type)
-    response = sampler.sample_qubo(qubo.dict)
-    return list(response)[0]
-    
+    response = sampler.sample(qubo.get_bqm(), **sample_params(solver_type, seed))
+    return best_samples(response, samples)
+
+# Solves problem with given vehicles' limits by tour solver. Returns solution of qubo
+# returned by problem.get_qubo_with_both_limits(vehicle_limits, ...), samples
+# and seed parameters work like in solve_qubo.
+def solve_tour(problem, vehicle_limits, order_const, capacity_const = 0.,
+               solver_type = 'permutation', samples = None, seed = None):
+    sampler = get_solver(solver_type)
+    response = sampler.sample_tour(problem, vehicle_limits, order_const, capacity_const,
+                                   **sample_params(solver_type, seed))
+    return best_samples(response, samples)
+
+# Returns parameters of sampling for solver.
+def sample_params(solver_type, seed = None):
+    if seed is None or solver_type not in seeded_solvers:
+        return dict()
+    return {'seed' : seed}
+
+# Returns the lowest energy sample of response or, if samples is given, SampleSet
+# with samples lowest energy samples.
+def best_samples(response, samples = None):
+    if samples is None:
+        return response.samples(n = 1, sorted_by = 'energy')[0]
+    return response.truncate(samples, sorted_by = 'energy')
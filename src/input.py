@@ -1,9 +1,16 @@
 import networkx as nx
 import csv
 import math
-from itertools import product
+from itertools import product, islice
 from vrp_problem import VRPProblem
+from concurrent.futures import ProcessPoolExecutor
+from heapq import heappush, heappop
 import numpy as np
+import hashlib
+import struct
+import warnings
+import glob
+import os
 
 # Creates directed graph from file.
 # Format : id1|id2|cost
@@ -21,12 +28,198 @@ def create_graph_from_csv(path):
 
     return g
 
+# Reads directed graph from file straight to CSR format, without creating networkx graph.
+# Returns (nodes, indptr, indices, data) : nodes is sorted list of ids of graph's nodes,
+# edges from nodes[i] go to nodes[indices[k]] and cost data[k] for k between indptr[i]
+# and indptr[i + 1] - 1. File is read in chunks of chunk_size lines, every chunk is
+# parsed by one np.loadtxt call. If the same edge is given many times, the last cost is used.
+# Format : id1,id2,cost, the first line is skipped and everything after # is comment.
+def read_csr_graph(path, chunk_size = 1000000):
+    edge_type = np.dtype([('id1', np.int64), ('id2', np.int64), ('cost', float)])
+    chunks = list()
+    with open(path, mode='r') as in_file:
+        next(in_file, None)
+        while True:
+            lines = list(islice(in_file, chunk_size))
+            if len(lines) == 0:
+                break
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', UserWarning)
+                chunk = np.loadtxt(lines, dtype=edge_type, delimiter=',', comments='#',
+                                   ndmin=1)
+            chunks.append(chunk)
+
+    edges = np.concatenate(chunks) if len(chunks) != 0 else np.zeros(0, dtype=edge_type)
+    edges_num = len(edges)
+    (nodes, positions) = np.unique(np.concatenate((edges['id1'], edges['id2'])),
+                                   return_inverse=True)
+    sources = positions[:edges_num]
+    targets = positions[edges_num:]
+
+    # The last occurrence of every edge, sorted by source and target.
+    keys = sources * len(nodes) + targets
+    (_, last) = np.unique(keys[::-1], return_index=True)
+    last = edges_num - 1 - last
+
+    indptr = np.zeros(len(nodes) + 1, dtype=int)
+    indptr[1:] = np.cumsum(np.bincount(sources[last], minlength=len(nodes)))
+    return (nodes.tolist(), indptr, targets[last], edges['cost'][last])
+
+# Returns graph in CSR format with reversed edges.
+def reverse_csr_graph(graph):
+    (nodes, indptr, indices, data) = graph
+    sources = np.repeat(np.arange(len(nodes)), np.diff(indptr))
+    order = np.argsort(indices, kind='stable')
+    reversed_indptr = np.zeros(len(nodes) + 1, dtype=int)
+    reversed_indptr[1:] = np.cumsum(np.bincount(indices, minlength=len(nodes)))
+    return (nodes, reversed_indptr, sources[order], data[order])
+
+# Returns matrix of the shortest paths' costs between terminals (ids of graph's nodes).
+# graph - graph in CSR format (see read_csr_graph)
+# workers - number of processes running Dijkstra's algorithm
+def terminal_distances(graph, terminals, workers = 1):
+    return graph_distances(graph, terminals, terminals, workers)
+
+# Returns matrix of the shortest paths' costs from sources to targets (ids of graph's nodes).
+def graph_distances(graph, sources, targets, workers = 1):
+    (nodes, indptr, indices, data) = graph
+    positions = {node: i for (i, node) in enumerate(nodes)}
+    sources = [positions[s] for s in sources]
+    targets = [positions[t] for t in targets]
+    adjacency = (indptr.tolist(), indices.tolist(), data.tolist())
+
+    if workers <= 1:
+        _init_dijkstra(*adjacency)
+        distances = [_dijkstra(source, targets) for source in sources]
+    else:
+        with ProcessPoolExecutor(max_workers = workers, initializer = _init_dijkstra,
+                                 initargs = adjacency) as pool:
+            distances = list(pool.map(_dijkstra, sources, [targets] * len(sources),
+                                      chunksize = max(1, len(sources) // (4 * workers))))
+
+    distances = np.array(distances, dtype=float).reshape(len(sources), len(targets))
+    if np.isinf(distances).any():
+        raise ValueError('Some terminals are unreachable from others.')
+    return distances
+
+# Returns matrix of the shortest paths' costs between terminals in graph from graph_path.
+# cache_dir - directory with cached matrices, None if they shouldn't be cached. Matrices
+# are kept in binary files keyed by hash of graph file and terminals, cached ones are
+# memory-mapped. If only some of terminals are in cached matrix, only costs from and to
+# other terminals are computed (with Dijkstra's algorithm on graph and reversed graph).
+# workers - number of processes running Dijkstra's algorithm
+def cached_terminal_distances(graph_path, terminals, cache_dir = None, workers = 1):
+    if cache_dir is None:
+        graph = read_csr_graph(graph_path)
+        return terminal_distances(graph, terminals, workers)
+
+    directory = os.path.join(cache_dir, _file_hash(graph_path))
+    os.makedirs(directory, exist_ok=True)
+    terminals = np.asarray(terminals, dtype=np.int64)
+    key = hashlib.sha256(terminals.tobytes()).hexdigest()
+    path = os.path.join(directory, key + '.npy')
+    if os.path.exists(path):
+        return np.load(path, mmap_mode='r')
+
+    graph = read_csr_graph(graph_path)
+    (cached_terminals, cached) = _best_cached_distances(directory, terminals)
+
+    if cached is None:
+        distances = terminal_distances(graph, terminals.tolist(), workers)
+    else:
+        index = {t: i for (i, t) in enumerate(cached_terminals.tolist())}
+        known = np.array([t in index for t in terminals.tolist()], dtype=bool)
+        known_index = [index[t] for t in terminals[known].tolist()]
+        new_terminals = terminals[~known].tolist()
+
+        distances = np.zeros((len(terminals), len(terminals)), dtype=float)
+        distances[np.ix_(known, known)] = cached[np.ix_(known_index, known_index)]
+        if len(new_terminals) != 0:
+            distances[~known, :] = graph_distances(graph, new_terminals,
+                                                   terminals.tolist(), workers)
+            distances[:, ~known] = graph_distances(reverse_csr_graph(graph), new_terminals,
+                                                   terminals.tolist(), workers).T
+
+    # Writing to temporary files first, so other processes never see incomplete files.
+    temp = '.%d.tmp.npy' % os.getpid()
+    np.save(os.path.join(directory, key + '.terminals' + temp), terminals)
+    os.replace(os.path.join(directory, key + '.terminals' + temp),
+               os.path.join(directory, key + '.terminals.npy'))
+    np.save(os.path.join(directory, key + temp), distances)
+    os.replace(os.path.join(directory, key + temp), path)
+
+    return np.load(path, mmap_mode='r')
+
+# Returns cached terminals with the biggest common part with terminals and their
+# memory-mapped matrix of costs, (None, None) if there is no such matrix.
+def _best_cached_distances(directory, terminals):
+    best = (None, None)
+    best_common = 0
+    for terminals_path in glob.glob(os.path.join(directory, '*.terminals.npy')):
+        path = terminals_path[:-len('.terminals.npy')] + '.npy'
+        if not os.path.exists(path):
+            continue
+        cached_terminals = np.load(terminals_path)
+        common = np.isin(terminals, cached_terminals).sum()
+        if common > best_common:
+            best = (cached_terminals, np.load(path, mmap_mode='r'))
+            best_common = common
+    return best
+
+# Returns hash of file's content.
+def _file_hash(path):
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as in_file:
+        for block in iter(lambda: in_file.read(1 << 20), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+# Graph used by _dijkstra, set once in every process.
+_dijkstra_graph = None
+
+def _init_dijkstra(indptr, indices, data):
+    global _dijkstra_graph
+    _dijkstra_graph = (indptr, indices, data)
+
+# Dijkstra's algorithm from source (position of node) on _dijkstra_graph. It stops when
+# all targets are reached. Returns list of costs of the shortest paths to targets.
+def _dijkstra(source, targets):
+    (indptr, indices, data) = _dijkstra_graph
+    dist = [math.inf] * (len(indptr) - 1)
+    settled = [False] * (len(indptr) - 1)
+    remaining = set(targets)
+
+    dist[source] = 0.
+    heap = [(0., source)]
+    while heap and remaining:
+        (d, v) = heappop(heap)
+        if settled[v]:
+            continue
+        settled[v] = True
+        remaining.discard(v)
+        for k in range(indptr[v], indptr[v + 1]):
+            u = indices[k]
+            new_dist = d + data[k]
+            if new_dist < dist[u]:
+                dist[u] = new_dist
+                heappush(heap, (new_dist, u))
+
+    return [dist[t] for t in targets]
+
 # Creates VRPProblem from test file and graph file.
 # path - path to test file
 # graph_path - path to graph file
 # capacity - True if vehicles have capacities, False otherwise
-def read_full_test(path, graph_path, capacity = True):
-    graph = create_graph_from_csv(graph_path)
+# workers - number of processes computing costs between nodes
+# cache_dir - directory where costs between nodes are cached, None if they shouldn't
+# be cached (see cached_terminal_distances)
+def read_full_test(path, graph_path, capacity = True, workers = 1, cache_dir = None):
+    test = read_full_test_arrays(path, graph_path, capacity, workers, cache_dir)
+    return create_problem(*test)
+
+# Reads test file and graph file. Returns number of magazines, costs, weights
+# and capacities (see read_full_test).
+def read_full_test_arrays(path, graph_path, capacity = True, workers = 1, cache_dir = None):
     in_file = open(path, 'r')
     
     nodes_id = list()
@@ -60,30 +253,21 @@ def read_full_test(path, graph_path, capacity = True):
 
     # Generating costs matrix.
     costs = np.zeros((nodes_num, nodes_num), dtype=int)
-    for i in range(nodes_num):
-        source = nodes_id[i]
-        _, paths = nx.single_source_dijkstra(graph, source, weight = 'cost')
-        for j in range(nodes_num):
-            d = nodes_id[j]
-            path = paths[d]
-        
-            prev = source
-            for node in path[1:]:
-                edge = graph.get_edge_data(prev, node)
-                costs[i][j] += edge['cost']
-                prev = node
+    costs[:, :] = cached_terminal_distances(graph_path, nodes_id, cache_dir, workers)
 
     in_file.close()
 
-    sources = [i for i in range(magazines_num)]
-    dests =  [i for i in range(magazines_num, nodes_num)]
-
-    return VRPProblem(sources, costs, capacities, dests, weights) 
+    return (magazines_num, costs, weights, capacities)
 
 # Creates VRPProblem from test file.
 # path - path to test file
 # capacity - True if vehicles have capacities, False otherwise
 def read_test(path, capacity = True):
+    return create_problem(*read_test_arrays(path, capacity))
+
+# Reads test file. Returns number of magazines, costs, weights and capacities.
+# Costs can be negative or fractional, they are integers if all of them are integers.
+def read_test_arrays(path, capacity = True):
     in_file = open(path, 'r')
     
     magazines_num = int(in_file.readline())
@@ -98,9 +282,10 @@ def read_test(path, capacity = True):
             weights[i + magazines_num] = w[i]
 
     # Reading costs.
-    costs = np.zeros((nodes_num, nodes_num), dtype=int)
-    for i in range(nodes_num):
-        costs[i] = [int(s) for s in in_file.readline().split() if s.isdigit()]
+    lines = [in_file.readline() for _ in range(nodes_num)]
+    costs = np.array(' '.join(lines).split(), dtype=float).reshape(nodes_num, nodes_num)
+    if (costs == np.round(costs)).all():
+        costs = costs.astype(int)
 
     # Reading vehicles.
     vehicles = int(in_file.readline())
@@ -110,6 +295,12 @@ def read_test(path, capacity = True):
 
     in_file.close()
 
+    return (magazines_num, costs, weights, capacities)
+
+# Creates VRPProblem with magazines 0, 1, ..., magazines_num - 1 and the rest of nodes
+# as destinations.
+def create_problem(magazines_num, costs, weights, capacities):
+    nodes_num = len(costs)
     sources = [i for i in range(magazines_num)]
     dests =  [i for i in range(magazines_num, nodes_num)]
 
@@ -121,33 +312,96 @@ def read_test(path, capacity = True):
 # out_path - output
 # capacity - True if vehicles have capacities, False otherwise
 def create_test(in_path, graph_path, out_path, capacity = True):
-    test = read_full_test(in_path, graph_path, capacity)
+    (magazines_num, costs, weights, capacities) = read_full_test_arrays(in_path, graph_path,
+                                                                        capacity)
     out_file = open(out_path, 'w+')
 
     # Number of magazines.
-    out_file.write(str(len(test.sources)) + '\n')
+    out_file.write(str(magazines_num) + '\n')
 
     # Number of destinations..
-    out_file.write(str(len(test.dests)) + '\n')
+    out_file.write(str(len(costs) - magazines_num) + '\n')
 
     # Weights of destinations.
     if capacity:
-        for dest in test.dests:
-            out_file.write(str(test.weights[dest])  + ' ')
+        out_file.write(''.join(str(w) + ' ' for w in weights[magazines_num:].tolist()))
         out_file.write('\n')
 
     # Costs.
-    n = len(test.sources) + len(test.dests)
-    for i in range(n):
-        for j in range(n):
-            out_file.write(str(test.costs[i][j]) + ' ')
-        out_file.write('\n')
+    for row in costs.tolist():
+        out_file.write(''.join(str(c) + ' ' for c in row) + '\n')
 
     # Vehicles.
-    out_file.write(str(len(test.capacities)) + '\n')
+    out_file.write(str(len(capacities)) + '\n')
     if capacity:
-        for i in range(len(test.capacities)):
-            out_file.write(str(test.capacities[i]) + ' ')
+        out_file.write(''.join(str(c) + ' ' for c in capacities))
         out_file.write('\n')
 
     out_file.close()
+
+# Binary test format. File starts with header : magic, version, number of magazines,
+# number of destinations, number of vehicles and type of costs (numpy's dtype string).
+# Then there are raw blocks (aligned to 64 bytes) : costs matrix, weights and capacities
+# (both int64), so costs can be memory-mapped without parsing.
+_binary_magic = b'VRPB'
+_binary_version = 1
+_binary_header = '<4sIQQQ8s'
+
+# Returns offsets of blocks in binary test.
+def _binary_offsets(nodes_num, costs_dtype):
+    align = lambda offset: (offset + 63) // 64 * 64
+    costs_offset = align(struct.calcsize(_binary_header))
+    weights_offset = align(costs_offset + nodes_num * nodes_num * np.dtype(costs_dtype).itemsize)
+    capacities_offset = align(weights_offset + nodes_num * 8)
+    return (costs_offset, weights_offset, capacities_offset)
+
+# Writes test in binary format.
+def write_binary_test(out_path, magazines_num, costs, weights, capacities):
+    costs = np.asarray(costs)
+    costs = costs.astype(costs.dtype.newbyteorder('<'))
+    weights = np.asarray(weights, dtype='<i8')
+    capacities = np.asarray(capacities, dtype='<i8')
+    nodes_num = len(costs)
+    offsets = _binary_offsets(nodes_num, costs.dtype)
+
+    with open(out_path, 'wb') as out_file:
+        out_file.write(struct.pack(_binary_header, _binary_magic, _binary_version,
+                                   magazines_num, nodes_num - magazines_num,
+                                   len(capacities), costs.dtype.str.encode()))
+        for (offset, block) in zip(offsets, (costs, weights, capacities)):
+            out_file.write(b'\0' * (offset - out_file.tell()))
+            out_file.write(block.tobytes())
+
+# Creates binary test from test in normal format (or in full format if graph_path is given).
+# in_path - test input file
+# out_path - output
+# capacity - True if vehicles have capacities, False otherwise
+# graph_path - graph input file, None if test is in normal format
+def create_binary_test(in_path, out_path, capacity = True, graph_path = None):
+    if graph_path is None:
+        test = read_test_arrays(in_path, capacity)
+    else:
+        test = read_full_test_arrays(in_path, graph_path, capacity)
+    write_binary_test(out_path, *test)
+
+# Creates VRPProblem from binary test. Costs and weights are memory-mapped copy-on-write,
+# so file isn't changed and its pages are shared between processes until they are changed.
+def read_binary_test(path):
+    with open(path, 'rb') as in_file:
+        header = in_file.read(struct.calcsize(_binary_header))
+    (magic, version, magazines_num, dests_num, vehicles, costs_dtype) = \
+            struct.unpack(_binary_header, header)
+    if magic != _binary_magic or version != _binary_version:
+        raise ValueError('File ' + path + ' is not binary test.')
+
+    nodes_num = magazines_num + dests_num
+    costs_dtype = np.dtype(costs_dtype.rstrip(b'\0').decode())
+    (costs_offset, weights_offset, capacities_offset) = _binary_offsets(nodes_num, costs_dtype)
+
+    costs = np.memmap(path, dtype=costs_dtype, mode='c', offset=costs_offset,
+                      shape=(nodes_num, nodes_num))
+    weights = np.memmap(path, dtype='<i8', mode='c', offset=weights_offset,
+                        shape=(nodes_num,))
+    capacities = np.fromfile(path, dtype='<i8', count=vehicles, offset=capacities_offset)
+
+    return create_problem(magazines_num, costs, weights, capacities.tolist())
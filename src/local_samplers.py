@@ -0,0 +1,518 @@
+# Classical QUBO samplers working only with numpy. They don't need any D-Wave's
+# service, so they can be used offline (e.g. in tests).
+# Qubo is kept as symmetric matrix in CSR format. Every read (restart) has its own
+# state and local fields, all reads are updated together with vectorized operations.
+
+import dimod
+import numpy as np
+
+# Qubo of binary quadratic model in form used by samplers.
+# Attributes :
+# variables - list of variables, i-th column of states is i-th variable
+# linear - array with linear biases
+# indptr, indices, data - symmetric matrix of quadratic biases in CSR format
+# offset - constant part of energy
+# vartype - vartype of sampled model, samples are converted back to it
+class CSRQubo:
+    def __init__(self, bqm):
+        self.vartype = bqm.vartype
+        if bqm.vartype is not dimod.BINARY:
+            bqm = bqm.change_vartype(dimod.BINARY, inplace=False)
+
+        self.variables = list(bqm.variables)
+        n = len(self.variables)
+        linear, (irow, icol, qdata), offset = bqm.to_numpy_vectors(
+                variable_order=self.variables)
+
+        rows = np.concatenate((irow, icol))
+        cols = np.concatenate((icol, irow))
+        data = np.concatenate((qdata, qdata)).astype(float)
+        order = np.argsort(rows, kind='stable')
+
+        self.linear = np.asarray(linear, dtype=float)
+        self.offset = float(offset)
+        self.indices = cols[order]
+        self.data = data[order]
+        self.indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=n), out=self.indptr[1:])
+
+    # Returns number of variables.
+    def size(self):
+        return len(self.variables)
+
+    # Returns local fields of states : linear bias + sum of quadratic biases
+    # with variables equal to 1. Flipping i-th variable changes energy by (1 - 2x_i) * field_i.
+    def fields(self, states):
+        (reads, n) = states.shape
+        row_of = np.repeat(np.arange(n), np.diff(self.indptr))
+        positions = row_of[np.newaxis, :] + n * np.arange(reads)[:, np.newaxis]
+        products = states[:, self.indices] * self.data
+        fields = np.bincount(positions.ravel(), weights=products.ravel(), minlength=reads * n)
+        return fields.reshape(reads, n) + self.linear
+
+    # Returns energies of states with given local fields.
+    def energies(self, states, fields):
+        return self.offset + 0.5 * (states @ self.linear + np.sum(states * fields, axis=1))
+
+    # Flips variables[read] in every read where dx[read] != 0 (dx = new - old value)
+    # and updates local fields.
+    def flip(self, states, fields, variables, dx):
+        reads = np.nonzero(dx)[0]
+        if len(reads) == 0:
+            return
+        variables = variables[reads]
+        dx = dx[reads]
+        states[reads, variables] += dx
+
+        starts = self.indptr[variables]
+        lengths = self.indptr[variables + 1] - starts
+        total = np.sum(lengths)
+        if total == 0:
+            return
+        positions = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        positions += np.repeat(starts, lengths)
+        np.add.at(fields, (np.repeat(reads, lengths), self.indices[positions]),
+                  np.repeat(dx, lengths) * self.data[positions])
+
+    # Returns range of inverse temperatures : at the beginning the biggest possible
+    # change of energy is accepted with probability 1/2, at the end the smallest
+    # one with probability 1/100.
+    def beta_range(self):
+        abs_data = np.abs(self.data)
+        row_of = np.repeat(np.arange(self.size()), np.diff(self.indptr))
+        max_delta = np.max(np.abs(self.linear) + np.bincount(row_of, weights=abs_data,
+                                                              minlength=self.size()))
+        values = np.concatenate((np.abs(self.linear), abs_data))
+        values = values[values > 0]
+        if len(values) == 0:
+            return (1., 1.)
+        min_delta = np.min(values)
+        return (np.log(2) / max_delta, np.log(100) / min_delta)
+
+# Returns sample set with given states of qubo, in vartype of sampled model.
+def create_sample_set(qubo, states, energies):
+    sample_set = dimod.SampleSet.from_samples((states.astype(np.int8), qubo.variables),
+                                              dimod.BINARY, energy=energies)
+    if qubo.vartype is not dimod.BINARY:
+        sample_set = sample_set.change_vartype(qubo.vartype, inplace=False)
+    return sample_set
+
+# Simulated annealing sampler. In every sweep all variables are visited in random
+# order and flipped with Metropolis criterion, temperature decreases geometrically.
+class AnnealingSampler(dimod.Sampler):
+    properties = dict()
+    parameters = {'num_reads' : [], 'num_sweeps' : [], 'beta_range' : [], 'seed' : []}
+
+    # Parameters are default parameters of sample method.
+    def __init__(self, num_reads = 10, num_sweeps = 200, beta_range = None, seed = None):
+        self.num_reads = num_reads
+        self.num_sweeps = num_sweeps
+        self.default_beta_range = beta_range
+        self.seed = seed
+
+    def sample(self, bqm, num_reads = None, num_sweeps = None, beta_range = None, seed = None):
+        num_reads = self.num_reads if num_reads is None else num_reads
+        num_sweeps = self.num_sweeps if num_sweeps is None else num_sweeps
+        beta_range = self.default_beta_range if beta_range is None else beta_range
+        seed = self.seed if seed is None else seed
+
+        qubo = CSRQubo(bqm)
+        n = qubo.size()
+        random = np.random.RandomState(seed)
+
+        states = random.randint(0, 2, size=(num_reads, n)).astype(float)
+        if n == 0:
+            return create_sample_set(qubo, states, np.full(num_reads, qubo.offset))
+        fields = qubo.fields(states)
+
+        if beta_range is None:
+            beta_range = qubo.beta_range()
+        betas = np.geomspace(beta_range[0], beta_range[1], num_sweeps)
+        indptr = qubo.indptr
+        indices = qubo.indices
+        data = qubo.data
+
+        for beta in betas:
+            thresholds = np.log(random.random_sample((n, num_reads))) / -beta
+            for var in random.permutation(n):
+                # Flip is accepted if delta < -log(u) / beta, i.e. u < exp(-beta * delta).
+                dx = 1 - 2 * states[:, var]
+                dx[dx * fields[:, var] >= thresholds[var]] = 0.
+                if not dx.any():
+                    continue
+                states[:, var] += dx
+                row = slice(indptr[var], indptr[var + 1])
+                fields[:, indices[row]] += dx[:, np.newaxis] * data[row]
+
+        return create_sample_set(qubo, states, qubo.energies(states, fields))
+
+# Tabu search sampler. In every iteration each read flips variable that gives the
+# lowest energy and isn't tabu (recently flipped), unless flipping it gives the best
+# energy found so far.
+class TabuSampler(dimod.Sampler):
+    properties = dict()
+    parameters = {'num_reads' : [], 'num_iterations' : [], 'tenure' : [], 'seed' : []}
+
+    # Parameters are default parameters of sample method.
+    # num_iterations - number of flips, None means 20 * number of variables
+    # tenure - number of iterations in which flipped variable is tabu, None means
+    # min(20, number of variables / 4)
+    def __init__(self, num_reads = 10, num_iterations = None, tenure = None, seed = None):
+        self.num_reads = num_reads
+        self.num_iterations = num_iterations
+        self.tenure = tenure
+        self.seed = seed
+
+    def sample(self, bqm, num_reads = None, num_iterations = None, tenure = None, seed = None):
+        num_reads = self.num_reads if num_reads is None else num_reads
+        num_iterations = self.num_iterations if num_iterations is None else num_iterations
+        tenure = self.tenure if tenure is None else tenure
+        seed = self.seed if seed is None else seed
+
+        qubo = CSRQubo(bqm)
+        n = qubo.size()
+        random = np.random.RandomState(seed)
+        if num_iterations is None:
+            num_iterations = 20 * n
+        if tenure is None:
+            tenure = min(20, n // 4)
+
+        states = random.randint(0, 2, size=(num_reads, n)).astype(float)
+        if n == 0:
+            return create_sample_set(qubo, states, np.full(num_reads, qubo.offset))
+        fields = qubo.fields(states)
+        energies = qubo.energies(states, fields)
+
+        best_states = states.copy()
+        best_energies = energies.copy()
+        tabu = np.zeros((num_reads, n), dtype=np.int64)
+        reads = np.arange(num_reads)
+
+        for iteration in range(1, num_iterations + 1):
+            delta = (1 - 2 * states) * fields
+            allowed = (tabu < iteration) | (energies[:, np.newaxis] + delta < best_energies[:, np.newaxis])
+            delta = np.where(allowed, delta, np.inf)
+            # Random noise breaks ties between variables.
+            variables = np.argmin(delta + random.random_sample(delta.shape) * 1e-9, axis=1)
+            change = delta[reads, variables]
+            movable = np.isfinite(change)
+
+            dx = np.where(movable, 1 - 2 * states[reads, variables], 0.)
+            qubo.flip(states, fields, variables, dx)
+            energies += np.where(movable, change, 0.)
+            tabu[reads[movable], variables[movable]] = iteration + tenure
+
+            improved = energies < best_energies
+            best_states[improved] = states[improved]
+            best_energies[improved] = energies[improved]
+
+        return create_sample_set(qubo, best_states, best_energies)
+
+# Simulated annealing working directly on VRP tour (not on qubo). State is assignment
+# of nodes to steps of vehicles (see VRPProblem.get_qubo_with_both_limits) : every
+# destination is visited once, first min_size steps of vehicle have destinations and
+# in other steps vehicle can wait in source. Moves (swap of two steps, relocation of
+# destination and reversal of part of vehicle's path) keep state correct, so there
+# is no need of only one constraints. Energy of state is energy of qubo without
+# constraints' terms and it is updated only by costs of changed edges.
+class PermutationSampler:
+
+    # Parameters are default parameters of sample_tour method.
+    def __init__(self, num_reads = 4, num_sweeps = 200, seed = None):
+        self.num_reads = num_reads
+        self.num_sweeps = num_sweeps
+        self.seed = seed
+
+    # Returns sample set with variables (step, dest) of qubo returned by
+    # problem.get_qubo_with_both_limits(vehicle_limits, ...).
+    def sample_tour(self, problem, vehicle_limits, order_const, capacity_const = 0.,
+                    num_reads = None, num_sweeps = None, seed = None):
+        num_reads = self.num_reads if num_reads is None else num_reads
+        num_sweeps = self.num_sweeps if num_sweeps is None else num_sweeps
+        seed = self.seed if seed is None else seed
+
+        tour = TourModel(problem, vehicle_limits, order_const, capacity_const)
+        random = np.random.RandomState(seed)
+
+        states = list()
+        energies = list()
+        for _ in range(num_reads):
+            (slots, energy) = tour.anneal(random, num_sweeps)
+            states.append(slots)
+            energies.append(energy)
+
+        return tour.sample_set(states, energies)
+
+# VRP tour used by PermutationSampler. Nodes have local numbers : destinations are
+# 0, 1, ..., dests_num - 1 and source is dests_num. slots[step] is node visited in step.
+class TourModel:
+    def __init__(self, problem, vehicle_limits, order_const, capacity_const):
+        from vrp_problem import get_qubo_template
+
+        limits = tuple((int(l), int(r)) for (l, r) in vehicle_limits)
+        dests_num = len(problem.dests)
+        self.nodes = list(problem.dests) + [problem.source]
+        self.source = dests_num
+        self.template = get_qubo_template(dests_num, limits,
+                                          problem.first_source, problem.last_source)
+
+        nodes = np.asarray(self.nodes)
+        self.costs = (np.asarray(problem.costs)[np.ix_(nodes, nodes)] * order_const).tolist()
+        weights = np.asarray(problem.weights, dtype=float)[nodes]
+        weights[self.source] = 0.
+        self.weights = weights.tolist()
+        self.capacity_const = capacity_const
+        self.capacities = [float(c) for c in problem.capacities]
+        self.first_source = problem.first_source
+        self.last_source = problem.last_source
+
+        # Description of steps : vehicle, first step of vehicle, last step of vehicle
+        # and first step in which vehicle can wait in source.
+        self.vehicle = list()
+        self.first = list()
+        self.last = list()
+        self.wait = list()
+        start = 0
+        for (vehicle, (min_size, max_size)) in enumerate(limits):
+            for _ in range(max_size):
+                self.vehicle.append(vehicle)
+                self.first.append(start)
+                self.last.append(start + max_size - 1)
+                self.wait.append(start + min_size)
+            start += max_size
+        self.steps = start
+        self.vehicles = len(limits)
+
+        if sum(l for (l, _) in limits) > dests_num or self.steps < dests_num:
+            raise ValueError('Destinations can not be assigned to steps with given limits.')
+
+    # Returns random correct state.
+    def random_state(self, random):
+        steps = np.arange(self.steps)
+        required = steps[steps < np.asarray(self.wait)]
+        optional = steps[steps >= np.asarray(self.wait)]
+        chosen = random.choice(optional, self.source - len(required), replace=False)
+
+        slots = np.full(self.steps, self.source)
+        slots[np.concatenate((required, chosen)).astype(np.int64)] = random.permutation(self.source)
+        return slots.tolist()
+
+    # Returns sum of costs of edges incident to given steps and travels from and to source.
+    def local_energy(self, slots, steps):
+        costs = self.costs
+        first = self.first
+        last = self.last
+        source = self.source
+        edges = set()
+        energy = 0.
+        for step in set(steps):
+            if step != first[step]:
+                edges.add(step - 1)
+            elif self.first_source:
+                energy += costs[source][slots[step]]
+            if step != last[step]:
+                edges.add(step)
+            elif self.last_source:
+                energy += costs[slots[step]][source]
+        for step in edges:
+            energy += costs[slots[step]][slots[step + 1]]
+        return energy
+
+    # Returns energy of whole state.
+    def energy(self, slots):
+        energy = self.local_energy(slots, range(self.steps))
+        loads = [0.] * self.vehicles
+        squares = [0.] * self.vehicles
+        for step in range(self.steps):
+            weight = self.weights[slots[step]]
+            loads[self.vehicle[step]] += weight
+            squares[self.vehicle[step]] += weight**2
+        for vehicle in range(self.vehicles):
+            energy += self._capacity_energy(vehicle, loads[vehicle], squares[vehicle])
+        return energy
+
+    # Returns energy of capacity qubo of vehicle with given sum of weights and sum of squares
+    # (sum of products of weights of all pairs of vehicle's destinations).
+    def _capacity_energy(self, vehicle, load, square):
+        if self.capacity_const == 0:
+            return 0.
+        return self.capacity_const * (load**2 - square) / 2 / self.capacities[vehicle]**2
+
+    # Swaps nodes in steps i and j. Returns change of energy or None if state would be incorrect.
+    def swap(self, slots, i, j, loads, squares):
+        source = self.source
+        a = slots[i]
+        b = slots[j]
+        if a == b or (a == source and j < self.wait[j]) or (b == source and i < self.wait[i]):
+            return None
+
+        before = self.local_energy(slots, (i, j))
+        slots[i] = b
+        slots[j] = a
+        delta = self.local_energy(slots, (i, j)) - before
+
+        u = self.vehicle[i]
+        v = self.vehicle[j]
+        if u != v and self.capacity_const != 0:
+            wa = self.weights[a]
+            wb = self.weights[b]
+            delta -= self._capacity_energy(u, loads[u], squares[u])
+            delta -= self._capacity_energy(v, loads[v], squares[v])
+            delta += self._capacity_energy(u, loads[u] - wa + wb, squares[u] - wa**2 + wb**2)
+            delta += self._capacity_energy(v, loads[v] - wb + wa, squares[v] - wb**2 + wa**2)
+        return delta
+
+    # Returns cost of travel between nodes a and b of the same vehicle. None means
+    # beginning (if it is a) or end (if it is b) of vehicle's path.
+    def link(self, a, b):
+        source = self.source
+        if a is None:
+            return self.costs[source][b] if self.first_source else 0.
+        if b is None:
+            return self.costs[a][source] if self.last_source else 0.
+        return self.costs[a][b]
+
+    # Moves node from step i to step j of the same vehicle, nodes between them are shifted.
+    # Returns change of energy or None if state would be incorrect.
+    def relocate(self, slots, i, j):
+        source = self.source
+        first = self.first[i]
+        last = self.last[i]
+        wait = self.wait[i]
+        node = slots[i]
+        if i == j or (node == source and j < wait):
+            return None
+        if i < wait <= j and slots[wait] == source:
+            return None
+
+        # Removing node from its place.
+        prev = slots[i - 1] if i != first else None
+        next = slots[i + 1] if i != last else None
+        delta = self.link(prev, next) - self.link(prev, node) - self.link(node, next)
+
+        # Inserting node between two nodes.
+        if j > i:
+            prev = slots[j]
+            next = slots[j + 1] if j != last else None
+        else:
+            prev = slots[j - 1] if j != first else None
+            next = slots[j]
+        delta += self.link(prev, node) + self.link(node, next) - self.link(prev, next)
+
+        del slots[i]
+        slots.insert(j, node)
+        return delta
+
+    # Reverses nodes between steps i and j (i < j) of the same vehicle.
+    # Returns change of energy or None if state would be incorrect.
+    def reverse(self, slots, i, j):
+        source = self.source
+        wait = self.wait[i]
+        for step in range(i, j + 1):
+            if slots[step] == source and i + j - step < wait:
+                return None
+
+        steps = range(i, j + 1)
+        before = self.local_energy(slots, steps)
+        slots[i:(j + 1)] = slots[i:(j + 1)][::-1]
+        return self.local_energy(slots, steps) - before
+
+    # Makes random move. Returns move (name and steps) and change of energy,
+    # which is None if move isn't correct.
+    def random_move(self, random, slots, loads, squares):
+        i = int(random.randint(self.steps))
+        move = random.randint(3)
+        if move == 0:
+            j = int(random.randint(self.steps))
+            return ('swap', i, j, self.swap(slots, i, j, loads, squares))
+
+        j = int(random.randint(self.first[i], self.last[i] + 1))
+        if move == 1:
+            return ('relocate', i, j, self.relocate(slots, i, j))
+        (i, j) = (min(i, j), max(i, j))
+        if i == j:
+            return ('reverse', i, j, None)
+        return ('reverse', i, j, self.reverse(slots, i, j))
+
+    # Undoes correct move.
+    def undo(self, slots, move, i, j):
+        if move == 'swap':
+            (slots[i], slots[j]) = (slots[j], slots[i])
+        if move == 'relocate':
+            slots.insert(i, slots.pop(j))
+        if move == 'reverse':
+            slots[i:(j + 1)] = slots[i:(j + 1)][::-1]
+
+    # Updates loads of vehicles after swap of steps i and j.
+    def _update_loads(self, slots, i, j, loads, squares):
+        u = self.vehicle[i]
+        v = self.vehicle[j]
+        if u == v:
+            return
+        wa = self.weights[slots[j]]
+        wb = self.weights[slots[i]]
+        loads[u] += wb - wa
+        loads[v] += wa - wb
+        squares[u] += wb**2 - wa**2
+        squares[v] += wa**2 - wb**2
+
+    # Runs one annealing from random state. Returns best state and its energy.
+    # Temperature decreases geometrically from temperature which accepts average
+    # increase of energy with probability 1/2 to 1/1000 of it.
+    def anneal(self, random, num_sweeps):
+        slots = self.random_state(random)
+        energy = self.energy(slots)
+        loads = [0.] * self.vehicles
+        squares = [0.] * self.vehicles
+        for step in range(self.steps):
+            loads[self.vehicle[step]] += self.weights[slots[step]]
+            squares[self.vehicle[step]] += self.weights[slots[step]]**2
+
+        best_slots = list(slots)
+        best_energy = energy
+        if self.steps < 2:
+            return (best_slots, best_energy)
+
+        # Estimating initial temperature.
+        increases = list()
+        for _ in range(100):
+            (move, i, j, delta) = self.random_move(random, slots, loads, squares)
+            if delta is not None:
+                self.undo(slots, move, i, j)
+                if delta > 0:
+                    increases.append(delta)
+        start_temp = np.mean(increases) / np.log(2) if increases else 1.
+        temps = np.geomspace(start_temp, start_temp / 1000, num_sweeps)
+
+        for temp in temps:
+            # Move is accepted if delta <= -temp * log(u), i.e. u <= exp(-delta / temp).
+            thresholds = -temp * np.log(random.random_sample(self.steps))
+            for threshold in thresholds.tolist():
+                (move, i, j, delta) = self.random_move(random, slots, loads, squares)
+                if delta is None:
+                    continue
+                if delta > threshold:
+                    self.undo(slots, move, i, j)
+                    continue
+                if move == 'swap':
+                    self._update_loads(slots, i, j, loads, squares)
+                energy += delta
+                if energy < best_energy - 1e-9:
+                    best_energy = energy
+                    best_slots = list(slots)
+
+        return (best_slots, best_energy)
+
+    # Returns sample set of states with variables of qubo.
+    def sample_set(self, states, energies):
+        template = self.template
+        variables = [(step, self.nodes[dest]) for (step, dest) in template.variables]
+        index = {var: i for (i, var) in enumerate(template.variables)}
+
+        samples = np.zeros((len(states), len(variables)), dtype=np.int8)
+        for (read, slots) in enumerate(states):
+            for (step, node) in enumerate(slots):
+                samples[read, index[(step, node)]] = 1
+
+        return dimod.SampleSet.from_samples((samples, variables), dimod.BINARY,
+                                            energy=energies)
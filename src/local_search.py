@@ -0,0 +1,239 @@
+# Classical local search improving solutions of VRP returned by solvers.
+# Routes are improved with moves : 2-opt (reversing part of route), Or-opt (moving
+# part of route with at most 3 destinations, also to other route) and exchange of two
+# destinations. Cost of every move is computed only from changed edges and moves are
+# tried only between destinations which are near (neighbour lists).
+
+from vrp_solution import VRPSolution, add_sources
+import numpy as np
+import time
+
+# Returns solution improved by local search (or the same solution if it can't be improved).
+# max_iterations - maximum number of passes over all destinations
+# time_limit - maximum time of search in seconds, None if there is no limit
+# neighbours - number of the nearest destinations tried in moves of every destination
+def polish(solution, max_iterations = 100, time_limit = None, neighbours = 10):
+    if solution is None or not solution.check():
+        return solution
+
+    search = LocalSearch(solution, neighbours)
+    search.run(max_iterations, time_limit)
+    polished = search.solution()
+
+    if polished.total_cost() < solution.total_cost():
+        return polished
+    return solution
+
+# Local search on routes of solution. Routes contain only destinations, all sources are
+# merged into source 0 (see VRPProblem).
+class LocalSearch:
+    def __init__(self, solution, neighbours = 10):
+        problem = solution.problem
+        dests = list(problem.dests)
+        dests_set = set(dests)
+
+        costs = np.array(problem.costs, dtype=float)
+        if not problem.first_source:
+            costs[0, :] = 0
+        if not problem.last_source:
+            costs[:, 0] = 0
+        costs[0][0] = 0
+
+        self.problem = problem
+        self.costs = costs.tolist()
+        self.weights = np.asarray(problem.weights).tolist()
+        self.capacities = list(problem.capacities)
+        self.routes = [[d for d in route if d in dests_set] for route in solution.solution]
+        self.loads = [sum(self.weights[d] for d in route) for route in self.routes]
+        self.where = dict()
+        self.prefix = dict()
+        for r in range(len(self.routes)):
+            self._update(r)
+
+        # Neighbour lists, the nearest destinations by (costs[a][b] + costs[b][a]) / 2.
+        self.neighbours = dict()
+        if len(dests) > 1:
+            dests_array = np.asarray(dests, dtype=int)
+            dists = costs[np.ix_(dests_array, dests_array)]
+            dists = dists + dists.T
+            np.fill_diagonal(dists, np.inf)
+            size = min(neighbours, len(dests) - 1)
+            nearest = np.argpartition(dists, size - 1, axis=1)[:, :size]
+            order = np.argsort(np.take_along_axis(dists, nearest, axis=1), axis=1)
+            nearest = np.take_along_axis(nearest, order, axis=1)
+            for (i, dest) in enumerate(dests):
+                self.neighbours[dest] = dests_array[nearest[i]].tolist()
+
+    # Returns solution with current routes.
+    def solution(self):
+        routes = add_sources(self.problem, [list(route) for route in self.routes])
+        return VRPSolution(self.problem, None, None, routes)
+
+    # Returns cost of all routes.
+    def cost(self):
+        costs = self.costs
+        cost = 0
+        for route in self.routes:
+            if len(route) == 0:
+                continue
+            path = [0] + route + [0]
+            cost += sum(costs[a][b] for (a, b) in zip(path[:-1], path[1:]))
+        return cost
+
+    # Improves routes until there is no improving move or budget is used.
+    def run(self, max_iterations = 100, time_limit = None):
+        start = time.perf_counter()
+        for _ in range(max_iterations):
+            improved = False
+            for dest in self.problem.dests:
+                if time_limit is not None and time.perf_counter() - start > time_limit:
+                    return
+                if self._improve(dest):
+                    improved = True
+            if not improved:
+                return
+
+    # Applies the first improving move of dest. Returns True if there was such move.
+    def _improve(self, dest):
+        for move in (self._two_opt, self._or_opt, self._exchange):
+            if move(dest):
+                return True
+        return False
+
+    # Updates positions and prefix sums of costs of r-th route after its change.
+    # prefix[r] = (forward, backward), forward[i] is cost of route[0], ..., route[i] and
+    # backward[i] of the same path reversed.
+    def _update(self, r):
+        costs = self.costs
+        route = self.routes[r]
+        forward = [0.]
+        backward = [0.]
+        for (i, dest) in enumerate(route):
+            self.where[dest] = (r, i)
+            if i != 0:
+                forward.append(forward[-1] + costs[route[i-1]][dest])
+                backward.append(backward[-1] + costs[dest][route[i-1]])
+        self.prefix[r] = (forward, backward)
+
+    # Returns node before position i of route (source 0 at the beginning).
+    def _before(self, route, i):
+        return route[i-1] if i > 0 else 0
+
+    # Returns node at position i of route (source 0 at the end).
+    def _at(self, route, i):
+        return route[i] if i < len(route) else 0
+
+    # 2-opt : makes edge dest -> neighbour by reversing part of route between them.
+    def _two_opt(self, dest):
+        costs = self.costs
+        (r, i) = self.where[dest]
+        route = self.routes[r]
+        (forward, backward) = self.prefix[r]
+
+        for neighbour in self.neighbours.get(dest, []):
+            (s, j) = self.where[neighbour]
+            if s != r or j <= i + 1:
+                continue
+
+            # Reversing route[i + 1], ..., route[j].
+            first = route[i + 1]
+            after = self._at(route, j + 1)
+            delta = (costs[dest][neighbour] + costs[first][after]
+                     - costs[dest][first] - costs[neighbour][after]
+                     + backward[j] - backward[i + 1] - forward[j] + forward[i + 1])
+            if delta < -1e-9:
+                route[i + 1:j + 1] = route[i + 1:j + 1][::-1]
+                self._update(r)
+                return True
+        return False
+
+    # Or-opt : moves part of route starting with dest (with 1, 2 or 3 destinations)
+    # right after or right before one of its neighbours, or to empty route.
+    def _or_opt(self, dest):
+        costs = self.costs
+        (r, i) = self.where[dest]
+        route = self.routes[r]
+
+        for length in range(1, 4):
+            if i + length > len(route):
+                break
+            part = route[i:i + length]
+            weight = sum(self.weights[d] for d in part)
+            before = self._before(route, i)
+            after = self._at(route, i + length)
+            removal = (costs[before][part[0]] + costs[part[-1]][after]
+                       - costs[before][after])
+
+            # Positions of insertion : (route, index before which part is inserted).
+            positions = list()
+            for neighbour in self.neighbours.get(dest, []):
+                (s, j) = self.where[neighbour]
+                positions.append((s, j + 1))
+                positions.append((s, j))
+            for s in range(len(self.routes)):
+                if len(self.routes[s]) == 0:
+                    positions.append((s, 0))
+
+            for (s, k) in positions:
+                if s == r and i <= k <= i + length:
+                    continue
+                if s != r and self.loads[s] + weight > self.capacities[s]:
+                    continue
+
+                target = self.routes[s]
+                x = self._before(target, k)
+                y = self._at(target, k)
+                delta = (costs[x][part[0]] + costs[part[-1]][y] - costs[x][y]) - removal
+                if delta < -1e-9:
+                    self._move(r, i, length, s, k)
+                    return True
+        return False
+
+    # Moves route r[i:i + length] to route s before position k (position in route s
+    # before the move).
+    def _move(self, r, i, length, s, k):
+        part = self.routes[r][i:i + length]
+        if s == r and k > i:
+            k -= length
+        del self.routes[r][i:i + length]
+        self.routes[s][k:k] = part
+
+        weight = sum(self.weights[d] for d in part)
+        self.loads[r] -= weight
+        self.loads[s] += weight
+        self._update(r)
+        if s != r:
+            self._update(s)
+
+    # Exchange : swaps dest with one of its neighbours.
+    def _exchange(self, dest):
+        costs = self.costs
+        weights = self.weights
+        (r, i) = self.where[dest]
+
+        for neighbour in self.neighbours.get(dest, []):
+            (s, j) = self.where[neighbour]
+            if s == r and abs(i - j) <= 1:
+                continue
+            if s != r:
+                diff = weights[neighbour] - weights[dest]
+                if (self.loads[r] + diff > self.capacities[r] or
+                        self.loads[s] - diff > self.capacities[s]):
+                    continue
+
+            route = self.routes[r]
+            other = self.routes[s]
+            (a, b) = (self._before(route, i), self._at(route, i + 1))
+            (c, d) = (self._before(other, j), self._at(other, j + 1))
+            delta = (costs[a][neighbour] + costs[neighbour][b] - costs[a][dest] - costs[dest][b]
+                     + costs[c][dest] + costs[dest][d] - costs[c][neighbour] - costs[neighbour][d])
+            if delta < -1e-9:
+                (route[i], other[j]) = (neighbour, dest)
+                if s != r:
+                    diff = weights[neighbour] - weights[dest]
+                    self.loads[r] += diff
+                    self.loads[s] -= diff
+                    self._update(s)
+                self._update(r)
+                return True
+        return False
@@ -1,43 +1,176 @@
-from itertools import product
+import dimod
+import numpy as np
 
-# Simple class that helps creating qubo dict for DWave solvers.
+# Simple class that helps creating qubo for DWave solvers.
+# Every variable (e.g. (step, dest) pair) gets consecutive integer index.
+# Terms are accumulated in numpy buffers (COO format) and duplicated terms
+# are summed up in one vectorized pass (see coalesce).
+# Values are stored unscaled, real value of term is scale * value. Thanks to
+# that merging doesn't need to touch terms that are already in qubo.
 class Qubo:
     def __init__(self):
-        self.dict = dict()
+        self.variables = list()
+        self.indices = dict()
 
-    # Creates new field in dict.
+        # Chunks of rows, columns and values of added terms.
+        self.rows = list()
+        self.cols = list()
+        self.values = list()
+        self.scale = 1.
+        self.coalesced = True
+
+        # Single terms added by add method, waiting for being moved to chunks.
+        self.pending = list()
+
+    # Returns index of variable. Creates new index if variable doesn't have it.
+    def get_index(self, var):
+        index = self.indices.get(var)
+        if index is None:
+            index = len(self.variables)
+            self.indices[var] = index
+            self.variables.append(var)
+        return index
+
+    # Returns numpy array with indices of given variables.
+    def get_indices(self, variables):
+        return np.array([self.get_index(var) for var in variables], dtype=np.int64)
+
+    # Returns number of variables.
+    def size(self):
+        return len(self.variables)
+
+    # Creates new field in qubo.
     def create_field(self, field):
-        self.dict[field] = 0
+        self.add(field, 0.)
 
-    # Creates new field in dict if it doesn't exist.
+    # Creates new field in qubo if it doesn't exist.
     def create_not_exist_field(self, field):
-        if field in self.dict:
-            return
         self.create_field(field)
 
+    # Adds terms given by arrays of indices of variables. Value can be scalar or array.
+    def add_terms(self, rows, cols, values):
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        values = np.broadcast_to(np.asarray(values, dtype=float) / self.scale, rows.shape)
+        self._append(rows.flatten(), cols.flatten(), values.flatten())
+
+    # Appends chunk of unscaled terms.
+    def _append(self, rows, cols, values):
+        self.coalesced = False
+        self.rows.append(rows)
+        self.cols.append(cols)
+        self.values.append(values)
+
     # Adds constraint to qubo that exactly one of given variables should be equal to 1.
     # Const parameter defines 'weight' of that constraint.
     def add_only_one_constraint(self, variables, const):
-        for var in variables:
-            self.create_not_exist_field((var, var))
-            self.dict[(var, var)] -= 2 * const
-        for field in product(variables, variables):
-            self.create_not_exist_field(field)
-            self.dict[field] += const
-
-    # Adds field to dict with given value.
+        self.add_only_one_constraints([self.get_indices(variables)], const)
+
+    # Adds constraints that exactly one variable in every group should be equal to 1.
+    # groups - 2d array with indices of variables, every row is one group.
+    # Every pair of variables in group gets one (upper-triangular) term.
+    def add_only_one_constraints(self, groups, const):
+        groups = np.asarray(groups, dtype=np.int64)
+        if groups.size == 0:
+            return
+        first, second = np.triu_indices(groups.shape[1], 1)
+        self.add_terms(groups, groups, -const)
+        self.add_terms(groups[:, first], groups[:, second], 2 * const)
+
+    # Adds field to qubo with given value.
     def add(self, field, value):
-        self.create_not_exist_field(field)
-        self.dict[field] += value
+        (var1, var2) = field
+        self.pending.append((self.get_index(var1), self.get_index(var2), value))
+
+    # Moves single terms to chunks.
+    def _flush(self):
+        if len(self.pending) == 0:
+            return
+        rows, cols, values = zip(*self.pending)
+        self.pending = list()
+        self.add_terms(rows, cols, values)
 
     # Merges qubo with another qubo. Consts parameters define 'weight' of each qubo.
+    # Cost is linear in size of merged qubo, terms of this qubo are only rescaled lazily.
     def merge_with(self, qubo, const1, const2):
-        for field in self.dict:
-            self.dict[field] *= const1
-        for field in qubo.dict:
-            self.create_not_exist_field(field)
-            self.dict[field] += qubo.dict[field] * const2
+        self._flush()
+        qubo._flush()
+        if const1 == 0:
+            self.rows = list()
+            self.cols = list()
+            self.values = list()
+            self.scale = 1.
+        else:
+            self.scale *= const1
+
+        factor = const2 * qubo.scale / self.scale
+        mapping = self.get_indices(qubo.variables)
+        for (rows, cols, values) in zip(qubo.rows, qubo.cols, qubo.values):
+            self._append(mapping[rows], mapping[cols], values * factor)
+
+    # Sums up duplicated terms. After that every field is stored exactly once,
+    # (i, j) and (j, i) are the same field stored as (min(i, j), max(i, j)).
+    def coalesce(self):
+        self._flush()
+        n = len(self.variables)
+
+        if len(self.rows) == 0:
+            empty = np.zeros(0, dtype=np.int64)
+            self.rows = [empty]
+            self.cols = [empty]
+            self.values = [np.zeros(0, dtype=float)]
+            return
+        if self.coalesced and self.scale == 1.:
+            return
+
+        rows = np.concatenate(self.rows)
+        cols = np.concatenate(self.cols)
+        keys = np.minimum(rows, cols) * n + np.maximum(rows, cols)
+        fields, inverse = np.unique(keys, return_inverse=True)
+        values = np.bincount(inverse, weights=np.concatenate(self.values),
+                             minlength=len(fields))
+
+        self.rows = [fields // n]
+        self.cols = [fields % n]
+        self.values = [values * self.scale]
+        self.scale = 1.
+        self.coalesced = True
+
+    # Sets variables and coalesced terms (every field given once, rows <= cols) of empty qubo.
+    def set_coo(self, variables, rows, cols, values):
+        self.variables = list(variables)
+        self.indices = {var: i for (i, var) in enumerate(self.variables)}
+        self.rows = [rows]
+        self.cols = [cols]
+        self.values = [values]
+        self.scale = 1.
+        self.coalesced = True
+
+    # Returns coalesced terms as arrays (rows, cols, values) of COO format.
+    def get_coo(self):
+        self.coalesce()
+        return self.rows[0], self.cols[0], self.values[0]
 
     # Returns qubos dict which can be used in communication with DWave.
     def get_dict(self):
-        return self.dict
+        variables = self.variables
+        rows, cols, values = self.get_coo()
+        return {(variables[r], variables[c]): v
+                for (r, c, v) in zip(rows.tolist(), cols.tolist(), values.tolist())}
+
+    # Dict representation kept for compatibility with code using qubo.dict.
+    @property
+    def dict(self):
+        return self.get_dict()
+
+    # Returns qubo as dimod.BinaryQuadraticModel.
+    def get_bqm(self):
+        n = len(self.variables)
+        rows, cols, values = self.get_coo()
+
+        diagonal = rows == cols
+        linear = np.bincount(rows[diagonal], weights=values[diagonal], minlength=n)
+        quadratic = (rows[~diagonal], cols[~diagonal], values[~diagonal])
+
+        return dimod.BinaryQuadraticModel.from_numpy_vectors(
+            linear, quadratic, 0., dimod.BINARY, variable_order=self.variables)
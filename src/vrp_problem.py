@@ -1,5 +1,8 @@
 from qubo_helper import Qubo
-from itertools import combinations, product
+from itertools import product
+from functools import lru_cache
+from multiprocessing import shared_memory
+import numpy as np
 
 # VRP problem with multi-source.
 # Class has informations about sources, costs, destinations, weights and capacities.
@@ -14,30 +17,31 @@ class VRPProblem:
     # weights - list of weights of orders
     # first_source - flag that says if we count travel between magazine and first destination to the cost
     # last_source - flag that says if we count travel between last destination and magazine to the cost
+    # Attributes in_nearest_sources and out_nearest_sources are arrays with the nearest source
+    # to (from) every destination.
     def __init__(self, sources, costs, capacities, dests, weights,
             first_source = True, last_source = True):
         # Merging all sources into one source.
         source = 0
         weights[source] = 0
         self.source = source
-        in_nearest_sources = dict()
-        out_nearest_sources = dict()
-
-        # Finding nearest source for all destinations.
-        for dest in dests:
-            in_nearest = sources[0]
-            out_nearest = sources[0]
-            for s in sources:
-                costs[source][s] = 0
-                costs[s][source] = 0
-                if costs[s][dest] < costs[in_nearest][dest]:
-                    in_nearest = s
-                if costs[dest][s] < costs[dest][out_nearest]:
-                    out_nearest = s
-            costs[source][dest] = costs[in_nearest][dest]
-            costs[dest][source] = costs[dest][out_nearest]
-            in_nearest_sources[dest] = in_nearest
-            out_nearest_sources[dest] = out_nearest
+        in_nearest_sources = np.zeros(len(costs), dtype=int)
+        out_nearest_sources = np.zeros(len(costs), dtype=int)
+
+        # Finding nearest source for all destinations, the first one in sources if there
+        # are many of them.
+        if len(dests) != 0:
+            sources_array = np.asarray(sources, dtype=int)
+            dests_array = np.asarray(dests, dtype=int)
+            costs[source, sources_array] = 0
+            costs[sources_array, source] = 0
+
+            in_nearest = sources_array[np.argmin(costs[np.ix_(sources_array, dests_array)], axis=0)]
+            out_nearest = sources_array[np.argmin(costs[np.ix_(dests_array, sources_array)], axis=1)]
+            costs[source, dests_array] = costs[in_nearest, dests_array]
+            costs[dests_array, source] = costs[dests_array, out_nearest]
+            in_nearest_sources[dests_array] = in_nearest
+            out_nearest_sources[dests_array] = out_nearest
 
         self.costs = costs
         self.capacities = capacities
@@ -49,34 +53,105 @@ class VRPProblem:
         self.last_source = last_source
         self.sources = sources
 
+    # Arrays moved to shared memory by share.
+    shared_arrays = ('costs', 'weights', 'capacities', 'in_nearest_sources',
+                     'out_nearest_sources')
+
+    # Returns copy of problem with costs, weights and nearest sources in shared memory.
+    # Pickled shared problem contains only names of shared memory blocks, so worker
+    # processes attach to its arrays without copying them (and without pickling costs).
+    # Process which shared problem should call release when workers finished.
+    def share(self):
+        problem = VRPProblem.__new__(VRPProblem)
+        problem.__dict__.update(self.__dict__)
+        problem._handles = dict()
+        problem._memories = list()
+        problem._owner = True
+
+        for name in self.shared_arrays:
+            array = np.asarray(getattr(self, name))
+            memory = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            shared = np.ndarray(array.shape, dtype=array.dtype, buffer=memory.buf)
+            shared[...] = array
+            setattr(problem, name, shared)
+            problem._handles[name] = (memory.name, array.shape, array.dtype.str)
+            problem._memories.append(memory)
+
+        return problem
+
+    # Stops using shared memory : arrays are copied to memory of process and shared
+    # memory is closed (and removed if this process shared problem).
+    def release(self):
+        if '_handles' not in self.__dict__:
+            return
+        for name in self.shared_arrays:
+            setattr(self, name, np.array(getattr(self, name)))
+        for memory in self._memories:
+            memory.close()
+            if self._owner:
+                memory.unlink()
+        del self._handles, self._memories, self._owner
+
+    # Shared problem is pickled without its arrays, they are attached in __setstate__.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if '_handles' in state:
+            for name in self.shared_arrays:
+                del state[name]
+            del state['_memories'], state['_owner']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if '_handles' not in state:
+            return
+        self._memories = list()
+        self._owner = False
+        for (name, (memory_name, shape, dtype)) in self._handles.items():
+            memory = shared_memory.SharedMemory(name=memory_name)
+            setattr(self, name, np.ndarray(shape, dtype=dtype, buffer=memory.buf))
+            self._memories.append(memory)
+
+    # Returns compact problem with source and given dests only. Its costs and weights are
+    # submatrices copied from this problem, source is 0 and dests are 1, ..., len(dests),
+    # so this problem isn't changed. Returns also array of ids of subproblem's nodes
+    # in this problem (nodes[local_id] = id).
+    def get_subproblem(self, dests, capacities, first_source = True, last_source = True):
+        nodes = np.array([self.source] + list(dests), dtype=int)
+        costs = np.asarray(self.costs)[np.ix_(nodes, nodes)]
+        weights = np.asarray(self.weights)[nodes]
+        local_dests = [i for i in range(1, len(nodes))]
+        problem = VRPProblem([0], costs, capacities, local_dests, weights,
+                             first_source, last_source)
+        return (problem, nodes)
+
     # Returns qubo with information about capacities.
+    # Every pair of different destinations visited in different steps between start_step
+    # and final_step costs product of their weights divided by capacity squared.
     def get_capacity_qubo(self, capacity, start_step, final_step):
         dests = self.dests
-        weights = self.weights
+        weights = np.asarray(self.weights)
         cap_qubo = Qubo()
 
-        for (d1, d2) in combinations(dests, 2):
-            for (s1, s2) in combinations(range(start_step, final_step + 1), 2):
-                index = ((s1, d1), (s2, d2))
-                index2 = ((s1, d2), (s2, d1))
-                cost = weights[d1] * weights[d2] / capacity**2
-                cap_qubo.add(index, cost)
-                cap_qubo.add(index2, cost)
+        variables = cap_qubo.get_indices(product(range(start_step, final_step + 1), dests))
+        variables = variables.reshape(-1, len(dests))
+        rows, cols, pairs = capacity_terms(variables)
+        values = np.outer(weights[dests], weights[dests]).ravel()[pairs] / capacity**2
+        cap_qubo.add_terms(rows, cols, values)
 
         return cap_qubo
 
     # Returns qubo with information about costs between destinations.
     def get_order_qubo(self, start_step, final_step, dests, costs):
-        source = self.source
         ord_qubo = Qubo()
 
         # Order constraints.
-        for step in range(start_step, final_step):
-            for dest1 in dests:
-                for dest2 in dests:
-                    cost = costs[dest1][dest2]
-                    index = ((step, dest1), (step + 1, dest2))
-                    ord_qubo.add(index, cost)
+        variables = ord_qubo.get_indices(product(range(start_step, final_step + 1), dests))
+        variables = variables.reshape(-1, len(dests))
+        costs = np.asarray(costs)
+        rows, cols, index = order_terms(variables[:-1], variables[1:], dests, dests,
+                                        costs.shape[1])
+        ord_qubo.add_terms(rows, cols, costs.ravel()[index])
 
         return ord_qubo
 
@@ -85,10 +160,10 @@ class VRPProblem:
     def get_first_dest_qubo(self, start_step, dests, costs, source):
         fir_qubo = Qubo()
 
-        for dest in dests:
-            in_index = ((start_step, dest), (start_step, dest))
-            in_cost = costs[source][dest]
-            fir_qubo.add(in_index, in_cost)
+        variables = fir_qubo.get_indices([(start_step, dest) for dest in dests])
+        costs = np.asarray(costs)
+        rows, cols, index = source_terms(variables, dests, source, costs.shape[1])
+        fir_qubo.add_terms(rows, cols, costs.ravel()[index])
 
         return fir_qubo
 
@@ -97,103 +172,271 @@ class VRPProblem:
     def get_last_dest_qubo(self, final_step, dests, costs, source):
         las_qubo = Qubo()
 
-        for dest in dests:
-            out_index = ((final_step, dest), (final_step, dest))
-            out_cost = costs[dest][source]
-            las_qubo.add(out_index, out_cost)
+        variables = las_qubo.get_indices([(final_step, dest) for dest in dests])
+        costs = np.asarray(costs)
+        rows, cols, index = source_terms(variables, dests, source, costs.shape[1],
+                                         reverse = True)
+        las_qubo.add_terms(rows, cols, costs.ravel()[index])
 
         return las_qubo
 
     # Returns qubo with additional constraint, that every vehicle has
     # specified number of deliveries that it need to serve.
     def get_qubo_with_partition(self, vehicle_partitions,
-            only_one_const, order_const):
+            only_one_const, order_const, capacity_const = 0.):
         limits = [(r, r) for r in vehicle_partitions]
         return self.get_qubo_with_both_limits(limits,
-                only_one_const, order_const)
+                only_one_const, order_const, capacity_const)
 
     # Returns qubo with additional constraint, that every vehicle has
     # specified maximum number of deliveries that it can serve.
     def get_qubo_with_limits(self, vehicle_limits,
-            only_one_const, order_const):
+            only_one_const, order_const, capacity_const = 0.):
         limits = [(0, r) for r in vehicle_limits]
         return self.get_qubo_with_both_limits(limits,
-                only_one_const, order_const)
+                only_one_const, order_const, capacity_const)
 
     # Returns qubo with additional constraint that every vehicle has
     # specified minimum and maximum number of deliveries that it can serve.
     # vehicles_limits - list of pairs (a, b), a <= b.
+    # capacity_const - multiplier for capacity qubo (see get_capacity_qubo) of every vehicle,
+    # 0 if capacities shouldn't be coded in qubo.
+    # Structure of qubo is taken from cache of templates, only costs are computed here.
     def get_qubo_with_both_limits(self, vehicle_limits,
-            only_one_const, order_const):
+            only_one_const, order_const, capacity_const = 0.):
+        limits = tuple((int(l), int(r)) for (l, r) in vehicle_limits)
+        template = get_qubo_template(len(self.dests), limits,
+                                     self.first_source, self.last_source, capacity_const != 0)
+
+        nodes = list(self.dests)
+        nodes.append(self.source)
+        return template.get_qubo(nodes, self.costs, only_one_const, order_const,
+                                 self.weights, self.capacities, capacity_const)
+
+    # Returns qubo without additional constraints.
+    def get_full_qubo(self, only_one_const, order_const, capacity_const = 0.):
+        dests = len(self.dests)
+        vehicles = len(self.capacities)
+
+        limits = [dests for _ in range(vehicles)]
+        return self.get_qubo_with_limits(limits, only_one_const, order_const, capacity_const)
+
+# Structure of qubo returned by VRPProblem.get_qubo_with_both_limits.
+# It depends only on number of destinations, vehicles' limits and first_source,
+# last_source flags, so one template is used by all problems of the same shape.
+# Template uses local numbers of nodes : destinations are 0, 1, ..., dests_num - 1
+# and source is dests_num. Every field of qubo has precomputed constraint's
+# coefficient and every cost term has precomputed position in local costs matrix.
+class QuboTemplate:
+
+    # Parameters :
+    # dests_num - number of destinations
+    # vehicle_limits - tuple of pairs (a, b), a <= b, see get_qubo_with_both_limits
+    # first_source, last_source - flags from VRPProblem
+    # capacity - True if template should contain capacity terms of every vehicle
+    def __init__(self, dests_num, vehicle_limits, first_source, last_source, capacity = False):
         steps = 0
         for (_, r) in vehicle_limits:
             steps += r
 
-        capacities = self.capacities
-        dests = self.dests
-        source = self.source
-        dests_with_source = dests.copy()
-        dests_with_source.append(source)
-        costs = self.costs
-        vrp_qubo = Qubo()
+        self.nodes_num = dests_num + 1
+        dests = np.arange(dests_num)
+        dests_with_source = np.arange(dests_num + 1)
+        source = dests_num
+
+        # Qubo with only one constraints (with const 1) used also to number variables.
+        qubo = Qubo()
+        self.cost_rows = list()
+        self.cost_cols = list()
+        self.cost_index = list()
+        self.cap_rows = list()
+        self.cap_cols = list()
+        self.cap_index = list()
+        self.cap_vehicle = list()
+
+        # Variables (step, dest) in order of steps. variables[step][i] is index of
+        # (step, i) or -1 if vehicle can't wait in source in that step.
+        variables = np.full((steps, dests_num + 1), -1, dtype=np.int64)
+        start = 0
+        for (min_size, max_size) in vehicle_limits:
+            for step in range(start, start + max_size):
+                step_dests = dests if step < start + min_size else dests_with_source
+                variables[step, :len(step_dests)] = qubo.get_indices(
+                        [(step, dest) for dest in step_dests.tolist()])
+            start += max_size
 
         # Only one step for one destination.
-        for dest in self.dests:
-            vrp_qubo.add_only_one_constraint([(step, dest) for step in range(steps)], only_one_const) 
+        qubo.add_only_one_constraints(variables[:, :dests_num].T, 1.)
 
         start = 0
-        for vehicle in range(len(vehicle_limits)):
-            min_size = vehicle_limits[vehicle][0]
-            max_size = vehicle_limits[vehicle][1]
+        for (vehicle, (min_size, max_size)) in enumerate(vehicle_limits):
             min_final = start + min_size - 1
             max_final = start + max_size - 1
+            if max_size == 0:
+                continue
+
+            # Capacity terms between all destinations in steps of vehicle.
+            if capacity:
+                rows, cols, pairs = capacity_terms(variables[start:(max_final + 1), :dests_num])
+                self.cap_rows.append(rows)
+                self.cap_cols.append(cols)
+                self.cap_index.append(pairs)
+                self.cap_vehicle.append(np.full(len(pairs), vehicle, dtype=np.int64))
+
+            # Variables of steps with normal destinations and steps in which vehicle can wait.
+            min_vars = variables[start:(min_final + 1), :dests_num]
+            max_vars = variables[(min_final + 1):(max_final + 1)]
 
             # First steps should have normal destinations.
             if min_size != 0:
-                for step in range(start, min_final + 1):
-                    vrp_qubo.add_only_one_constraint([(step, dest) for dest in dests], only_one_const) 
-                ord_min_qubo = self.get_order_qubo(start, min_final, dests, costs)
-                vrp_qubo.merge_with(ord_min_qubo, 1., order_const)
+                qubo.add_only_one_constraints(min_vars, 1.)
+                self._add_cost_terms(order_terms(min_vars[:-1], min_vars[1:],
+                                                 dests, dests, self.nodes_num))
 
             # In other steps vehicles can wait in source.
             if max_size != min_size:
-                for step in range(min_final + 1, max_final + 1):
-                    vrp_qubo.add_only_one_constraint([(step, dest) for dest in dests_with_source], only_one_const)
-                ord_max_qubo = self.get_order_qubo(min_final + 1, max_final, dests_with_source, costs)
-                vrp_qubo.merge_with(ord_max_qubo, 1., order_const)
+                qubo.add_only_one_constraints(max_vars, 1.)
+                self._add_cost_terms(order_terms(max_vars[:-1], max_vars[1:], dests_with_source,
+                                                 dests_with_source, self.nodes_num))
 
             # From min_final step to min_final + 1 step.
             if min_size != 0 and min_size != max_size:
-                for dest1 in dests:
-                    for dest2 in dests_with_source:
-                        cost = costs[dest1][dest2]
-                        index = ((min_final, dest1), (min_final + 1, dest2))
-                        vrp_qubo.add(index, cost * order_const)
+                self._add_cost_terms(order_terms(min_vars[-1:], max_vars[:1],
+                                                 dests, dests_with_source, self.nodes_num))
 
             # First and last destinations.
-            if self.first_source:
-                fir_qubo = None
+            if first_source:
                 if min_size != 0:
-                    fir_qubo = self.get_first_dest_qubo(start, dests, costs, source)
+                    self._add_cost_terms(source_terms(min_vars[0], dests, source,
+                                                      self.nodes_num))
                 else:
-                    fir_qubo = self.get_first_dest_qubo(start, dests_with_source, costs, source)
-                vrp_qubo.merge_with(fir_qubo, 1., order_const)
-            if self.last_source:
-                las_qubo = None
+                    self._add_cost_terms(source_terms(max_vars[0], dests_with_source, source,
+                                                      self.nodes_num))
+            if last_source:
                 if max_size != min_size:
-                    las_qubo = self.get_last_dest_qubo(max_final, dests_with_source, costs, source)
+                    self._add_cost_terms(source_terms(max_vars[-1], dests_with_source, source,
+                                                      self.nodes_num, reverse = True))
                 else:
-                    las_qubo = self.get_last_dest_qubo(max_final, dests, costs, source)
-                vrp_qubo.merge_with(las_qubo, 1., order_const)
+                    self._add_cost_terms(source_terms(min_vars[-1], dests, source,
+                                                      self.nodes_num, reverse = True))
 
             start = max_final + 1
 
-        return vrp_qubo
+        self._compile(qubo)
 
-    # Returns qubo without additional constraints.
-    def get_full_qubo(self, only_one_const, order_const):
-        dests = len(self.dests)
-        vehicles = len(self.capacities)
+    # Adds cost terms given by order_terms or source_terms.
+    def _add_cost_terms(self, terms):
+        rows, cols, index = terms
+        self.cost_rows.append(rows)
+        self.cost_cols.append(cols)
+        self.cost_index.append(index)
 
-        limits = [dests for _ in range(vehicles)]
-        return self.get_qubo_with_limits(limits, only_one_const, order_const)
+    # Merges constraints' terms, cost terms and capacity terms into one list of fields.
+    def _compile(self, qubo):
+        n = qubo.size()
+        pen_rows, pen_cols, pen_values = qubo.get_coo()
+        cost_rows = concatenate(self.cost_rows)
+        cap_rows = concatenate(self.cap_rows)
+
+        rows = np.concatenate((pen_rows, cost_rows, cap_rows))
+        cols = np.concatenate((pen_cols, concatenate(self.cost_cols), concatenate(self.cap_cols)))
+        keys = np.minimum(rows, cols) * n + np.maximum(rows, cols)
+        fields, inverse = np.unique(keys, return_inverse=True)
+        cost_start = len(pen_rows)
+        cap_start = cost_start + len(cost_rows)
+
+        self.variables = qubo.variables
+        self.rows = fields // n
+        self.cols = fields % n
+        self.only_one_values = np.zeros(len(fields), dtype=float)
+        self.only_one_values[inverse[:cost_start]] = pen_values
+        self.cost_fields = inverse[cost_start:cap_start]
+        self.cost_index = concatenate(self.cost_index)
+        self.cap_fields = inverse[cap_start:]
+        self.cap_index = concatenate(self.cap_index)
+        self.cap_vehicle = concatenate(self.cap_vehicle)
+        self.cost_rows = None
+        self.cost_cols = None
+        self.cap_rows = None
+        self.cap_cols = None
+
+        # Arrays are shared by all qubos created from template.
+        self.rows.flags.writeable = False
+        self.cols.flags.writeable = False
+
+    # Returns qubo for problem with given nodes.
+    # nodes - ids of destinations and source at the end (real numbers of local nodes)
+    # costs - 2d array with costs of travel between nodes (indexed by ids)
+    # weights, capacities - weights of nodes (indexed by ids) and capacities of vehicles,
+    # used only if template has capacity terms
+    def get_qubo(self, nodes, costs, only_one_const, order_const,
+                 weights = None, capacities = None, capacity_const = 0.):
+        nodes = np.asarray(nodes)
+        local_costs = np.asarray(costs)[np.ix_(nodes, nodes)].ravel()
+
+        values = self.only_one_values * only_one_const
+        values += np.bincount(self.cost_fields, weights=local_costs[self.cost_index],
+                              minlength=len(values)) * order_const
+
+        if len(self.cap_fields) != 0:
+            local_weights = np.asarray(weights, dtype=float)[nodes[:-1]]
+            capacities = np.asarray(capacities, dtype=float)
+            cap_values = np.outer(local_weights, local_weights).ravel()[self.cap_index]
+            cap_values /= capacities[self.cap_vehicle]**2
+            values += np.bincount(self.cap_fields, weights=cap_values,
+                                  minlength=len(values)) * capacity_const
+
+        node_ids = nodes.tolist()
+        variables = [(step, node_ids[dest]) for (step, dest) in self.variables]
+
+        qubo = Qubo()
+        qubo.set_coo(variables, self.rows, self.cols, values)
+        return qubo
+
+# Returns terms of capacity qubo for given 2d array with indices of variables (step, dest).
+# Every pair of different destinations in different steps has one term. Returns arrays of
+# rows, columns and indices of pairs of destinations in flattened dests x dests matrix.
+def capacity_terms(variables):
+    steps_num, dests_num = variables.shape
+    step1, step2 = np.triu_indices(steps_num, 1)
+    dest1, dest2 = np.nonzero(~np.eye(dests_num, dtype=bool))
+    shape = (len(step1), len(dest1))
+
+    rows = variables[step1][:, dest1]
+    cols = variables[step2][:, dest2]
+    pairs = np.broadcast_to(dest1 * dests_num + dest2, shape)
+    return rows.ravel(), cols.ravel(), pairs.ravel()
+
+# Returns terms of costs of travel between consecutive steps.
+# from_vars, to_vars - 2d arrays with indices of variables, to_vars[i] are variables
+# of step following step of from_vars[i].
+# from_dests, to_dests - nodes of columns of from_vars and to_vars.
+# Returns arrays of rows, columns and indices of costs in flattened costs matrix
+# with nodes_num columns.
+def order_terms(from_vars, to_vars, from_dests, to_dests, nodes_num):
+    from_dests = np.asarray(from_dests, dtype=np.int64)
+    to_dests = np.asarray(to_dests, dtype=np.int64)
+    shape = (len(from_vars), len(from_dests), len(to_dests))
+    index = from_dests[:, np.newaxis] * nodes_num + to_dests[np.newaxis, :]
+    rows = np.broadcast_to(from_vars[:, :, np.newaxis], shape)
+    cols = np.broadcast_to(to_vars[:, np.newaxis, :], shape)
+    return rows.ravel(), cols.ravel(), np.broadcast_to(index, shape).ravel()
+
+# Returns terms of costs of travel from source to destinations (or from destinations
+# to source if reverse is True) in step with given variables, like order_terms.
+def source_terms(variables, dests, source, nodes_num, reverse = False):
+    dests = np.asarray(dests, dtype=np.int64)
+    index = dests * nodes_num + source if reverse else source * nodes_num + dests
+    return variables, variables, index
+
+# Concatenates list of arrays of indices, also the empty one.
+def concatenate(arrays):
+    if len(arrays) == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate(arrays)
+
+# Returns QuboTemplate for given shape of problem. Templates are cached, least recently
+# used templates are removed from cache.
+@lru_cache(maxsize = 32)
+def get_qubo_template(dests_num, vehicle_limits, first_source, last_source, capacity = False):
+    return QuboTemplate(dests_num, vehicle_limits, first_source, last_source, capacity)
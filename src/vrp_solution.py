@@ -1,3 +1,6 @@
+import dimod
+import numpy as np
+
 # Solution of VRP problem with multi-source. 
 # Class can decode solution from solution of QUBO.
 # Class provides methods to check and get informations about solution.
@@ -5,54 +8,31 @@ class VRPSolution:
 
     # Parameters :
     # problem - VRPProblem object
-    # sample - QUBO solution returned by D-Wave
+    # sample - QUBO solution returned by D-Wave (mapping from variables to values or
+    # dimod's SampleSet, then its first sample is decoded)
     # vehicle_limits - maximum number of deliveries that vehicles could serve. Used only
     # to decode solution from QUBO solution. Used only by AveragePartitionSolver.
     # solution - solution in final form : list of the lists of vehicles paths. Used to
     # create VRPSolution other way than from QUBO solution. 
     # It is needed to provide sample or solution parameter.
+    # Attribute violations is number of broken one-hot constraints in decoded sample.
     def __init__(self, problem, sample = None, vehicle_limits = None, solution = None):
         self.problem = problem
+        self.violations = 0
         
         if solution != None:
             self.solution = solution
         else:
-            if vehicle_limits == None:
-                dests = len(self.problem.dests)
-                vehicles = len(self.problem.capacities)
-                vehicle_limits = [dests for _ in range(vehicles)]
-
-            result = list()
-            vehicle_result = list()
-            step = 0
-            vehicle = 0
-
-            # Decoding solution from qubo sample.
-            for (s, dest) in sample:
-                if sample[(s, dest)] == 1:
-                    if dest != 0:
-                        vehicle_result.append(dest)
-                    step += 1
-                    if vehicle_limits[vehicle] == step:
-                        result.append(vehicle_result)
-                        step = 0
-                        vehicle += 1
-                        vehicle_result = list()
-                        if len(vehicle_limits) <= vehicle:
-                            break
-
-            # Adding first and last magazine.
-            for l in result:
-                if len(l) != 0:
-                    if problem.first_source:
-                        l.insert(0, problem.in_nearest_sources[l[0]])
-                    if problem.last_source:
-                        l.append(problem.out_nearest_sources[l[len(l) - 1]])
-
-            self.solution = result
+            (states, variables) = sample_arrays(sample)
+            (routes, violations) = decode_routes(problem, states[:1], variables, vehicle_limits)
+            self.solution = add_sources(problem, routes[0])
+            self.violations = int(violations[0])
 
     # Checks if solution is correct.
     def check(self):
+        if self.violations > 0:
+            return False
+
         capacities = self.problem.capacities
         weights = self.problem.weights
         solution = self.solution
@@ -142,3 +122,79 @@ class VRPSolution:
 
             vehicle_num += 1
 
+# Decodes all samples of dimod's SampleSet at once. Returns list of VRPSolutions.
+def decode_solutions(problem, samples, vehicle_limits = None):
+    (states, variables) = sample_arrays(samples)
+    (routes, violations) = decode_routes(problem, states, variables, vehicle_limits)
+
+    solutions = list()
+    for (sample_routes, sample_violations) in zip(routes, violations):
+        solution = VRPSolution(problem, None, None, add_sources(problem, sample_routes))
+        solution.violations = int(sample_violations)
+        solutions.append(solution)
+    return solutions
+
+# Returns states of samples as 2-D array (row for every sample) and list of variables.
+# samples - dimod's SampleSet or one sample (mapping from variables to values).
+def sample_arrays(samples):
+    if isinstance(samples, dimod.SampleSet):
+        return (samples.record.sample, list(samples.variables))
+    (states, variables) = dimod.as_samples(samples)
+    return (states, list(variables))
+
+# Decodes routes of vehicles from states of samples with variables (step, node).
+# Samples are reshaped to steps x nodes matrices, node visited in step is taken with argmax.
+# Returns list of routes (without sources) for every sample and array with number of
+# one-hot violations for every sample : steps without exactly one node and destinations
+# not visited exactly once.
+def decode_routes(problem, states, variables, vehicle_limits = None):
+    dests = problem.dests
+    source = problem.source
+    if vehicle_limits == None:
+        vehicle_limits = [len(dests) for _ in problem.capacities]
+
+    labels = np.array(variables, dtype=int).reshape(-1, 2)
+    (steps, nodes) = (labels[:, 0], labels[:, 1])
+    (nodes_list, node_index) = np.unique(nodes, return_inverse=True)
+    steps_num = sum(vehicle_limits)
+    if len(steps) != 0:
+        steps_num = max(steps_num, int(steps.max()) + 1)
+
+    matrix = np.zeros((len(states), steps_num, len(nodes_list)), dtype=np.int8)
+    matrix[:, steps, node_index] = states
+
+    # One-hot constraints of steps and destinations.
+    step_counts = matrix.sum(axis=2)
+    node_counts = matrix.sum(axis=1)
+    dests_index = np.searchsorted(nodes_list, dests)
+    present = dests_index < len(nodes_list)
+    present[present] = nodes_list[dests_index[present]] == np.asarray(dests)[present]
+    dest_counts = np.zeros((len(states), len(dests)), dtype=int)
+    dest_counts[:, present] = node_counts[:, dests_index[present]]
+    violations = (step_counts != 1).sum(axis=1) + (dest_counts != 1).sum(axis=1)
+
+    if len(nodes_list) == 0:
+        return ([[[] for _ in vehicle_limits] for _ in states], violations)
+
+    chosen = nodes_list[matrix.argmax(axis=2)]
+    visited = (step_counts > 0) & (chosen != source)
+
+    bounds = np.concatenate(([0], np.cumsum(vehicle_limits)))
+    routes = list()
+    for (sample_chosen, sample_visited) in zip(chosen, visited):
+        sample_routes = list()
+        for (begin, end) in zip(bounds[:-1], bounds[1:]):
+            sample_routes.append(sample_chosen[begin:end][sample_visited[begin:end]].tolist())
+        routes.append(sample_routes)
+
+    return (routes, violations)
+
+# Adds first and last magazine to routes.
+def add_sources(problem, routes):
+    for l in routes:
+        if len(l) != 0:
+            if problem.first_source:
+                l.insert(0, int(problem.in_nearest_sources[l[0]]))
+            if problem.last_source:
+                l.append(int(problem.out_nearest_sources[l[len(l) - 1]]))
+    return routes
@@ -1,11 +1,12 @@
 from qubo_helper import Qubo
 from vrp_problem import VRPProblem
-from vrp_solution import VRPSolution
+from vrp_solution import VRPSolution, decode_solutions
 from itertools import product
 import DWaveSolvers
+import local_search
 import networkx as nx
 import numpy as np
-from queue import Queue
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 # Abstract class for VRP solvers.
 class VRPSolver:
@@ -21,26 +22,83 @@ class VRPSolver:
     # It is recommended to set order_const = 1 and only_one_const
     # big enough to make solutions correct. Bigger than sum of all
     # costs should be enough.
-    def solve(self, only_one_const, order_const, solver_type = 'cpu'):
+    # polish - if True, solution is improved with classical local search
+    # (see local_search.py).
+    def solve(self, only_one_const, order_const, solver_type = 'cpu', polish = False):
+        solution = self._solve(only_one_const, order_const, solver_type = solver_type)
+        if polish:
+            solution = local_search.polish(solution)
+        return solution
+
+    # Solves problem, implemented by every solver.
+    def _solve(self, only_one_const, order_const, solver_type = 'cpu'):
         pass
 
+    # Returns solution of qubo with given vehicles' limits (see VRPProblem.get_qubo_with_both_limits).
+    # Tour solvers (e.g. 'permutation') don't need qubo, they work directly on problem.
+    # If samples is given, returns SampleSet with samples lowest energy solutions.
+    def _solve_with_limits(self, vehicle_limits, only_one_const, order_const,
+                           capacity_const, solver_type, samples = None, seed = None):
+        if solver_type in DWaveSolvers.tour_solvers:
+            return DWaveSolvers.solve_tour(self.problem, vehicle_limits, order_const,
+                                           capacity_const, solver_type = solver_type,
+                                           samples = samples, seed = seed)
+
+        qubo = self.problem.get_qubo_with_both_limits(vehicle_limits,
+                only_one_const, order_const, capacity_const)
+        return DWaveSolvers.solve_qubo(qubo, solver_type = solver_type, samples = samples,
+                                       seed = seed)
+
+    # Decodes every sample and returns correct solution with the lowest total cost.
+    # If there is no correct solution, returns solution decoded from the first sample.
+    def _best_solution(self, samples, vehicle_limits = None):
+        solutions = decode_solutions(self.problem, samples, vehicle_limits)
+        best = solutions[0]
+        for solution in solutions:
+            if not solution.check():
+                continue
+            if not best.check() or solution.total_cost() < best.total_cost():
+                best = solution
+        return best
+
 # Solver solves VRP only by QUBO formulation.
+# Attributes : capacity_const - multiplier for capacity qubo, 0 if capacities shouldn't be
+# coded in qubo (see VRPProblem.get_capacity_qubo).
+# samples - number of the lowest energy samples decoded, the best correct one is returned.
+# seed - seed passed to sampler, None if sampler's default should be used.
 class FullQuboSolver(VRPSolver):
-    def solve(self, only_one_const, order_const, solver_type = 'cpu'):
-        qubo = self.problem.get_full_qubo(only_one_const, order_const)
-        sample = DWaveSolvers.solve_qubo(qubo, solver_type = solver_type)
-        solution = VRPSolution(self.problem, sample)
-        return solution
+    def __init__(self, problem, capacity_const = 0., samples = 1, seed = None):
+        self.problem = problem
+        self.capacity_const = capacity_const
+        self.samples = samples
+        self.seed = seed
+
+    def _solve(self, only_one_const, order_const, solver_type = 'cpu'):
+        dests = len(self.problem.dests)
+        vehicles = len(self.problem.capacities)
+
+        limits = [(0, dests) for _ in range(vehicles)]
+        samples = self._solve_with_limits(limits, only_one_const, order_const,
+                                          self.capacity_const, solver_type, self.samples,
+                                          self.seed)
+        return self._best_solution(samples)
 
 # Solver assumes that every vehicle serves approximately the same number of deliveries.
 # Additional attribute : limit_radius - maximum difference between served number of deliveries
 # and average number of deliveries that every vehicle should serve.
+# capacity_const - multiplier for capacity qubo, 0 if capacities shouldn't be coded in qubo.
+# samples - number of the lowest energy samples decoded, the best correct one is returned.
+# seed - seed passed to sampler, None if sampler's default should be used.
 class AveragePartitionSolver(VRPSolver):
-    def __init__(self, problem, limit_radius = 1):
+    def __init__(self, problem, limit_radius = 1, capacity_const = 0., samples = 1,
+                 seed = None):
         self.problem = problem
         self.limit_radius = limit_radius
+        self.capacity_const = capacity_const
+        self.samples = samples
+        self.seed = seed
 
-    def solve(self, only_one_const, order_const, solver_type = 'cpu'):
+    def _solve(self, only_one_const, order_const, solver_type = 'cpu'):
         dests = len(self.problem.dests)
         vehicles = len(self.problem.capacities)
 
@@ -50,89 +108,93 @@ class AveragePartitionSolver(VRPSolver):
         limits = [(max(avg - limit_radius, 0), min(avg + limit_radius, dests)) for _ in range(vehicles)]
         max_limits = [r for (_, r) in limits]
 
-        vrp_qubo = self.problem.get_qubo_with_both_limits(limits,
-                only_one_const, order_const)
-
-        sample = DWaveSolvers.solve_qubo(vrp_qubo, solver_type = solver_type)
+        samples = self._solve_with_limits(limits, only_one_const, order_const,
+                                          self.capacity_const, solver_type, self.samples,
+                                          self.seed)
 
-        solution = VRPSolution(self.problem, sample, max_limits)
-        return solution
+        return self._best_solution(samples, max_limits)
 
 # Solver uses DBScan to divide problem into subproblems that can be solved effectively by FullQuboSolver.
 # Attributes : max_len - maximum number of deliveries in problems solved by FullQuboSolver.
 # anti_noiser : True if dbscan should eliminate singleton clusters, False otherwise.
+# max_workers - number of clusters solved in parallel.
+# executor - 'process' or 'thread', pool used for parallel solving. If it is None, threads
+# are used for remote solvers (qpu) and processes for the others.
+# seed - if it is given, i-th cluster is solved with seed + i, so results are reproducible.
 class DBScanSolver(VRPSolver):
 
-    def __init__(self, problem, max_len = 10, anti_noiser = True):
+    def __init__(self, problem, max_len = 10, anti_noiser = True, max_workers = 1,
+                 executor = None, seed = None):
         self.problem = problem
         self.anti_noiser = anti_noiser
         self.max_len = max_len
+        self.max_workers = max_workers
+        self.executor = executor
+        self.seed = seed
         self.max_weight = max(problem.capacities)
         self.max_dist = 2 * max(map(max, problem.costs))
 
-    # Returns subset of dests with elements x that satisfies
-    # costs[source][x] + costs[x][source] <= 2 * radius
-    def _range_query(self, dests, costs, source, radius):
-        result = list()
+    # Returns single-linkage dendrogram of dests : edges (a, b) of minimum spanning tree
+    # of dests with distances (costs[a][b] + costs[b][a]) / 2, sorted by distance.
+    # Dbscan with min_size = 1 and radius r (without noise) finds connected components
+    # of dests joined by edges not longer than r, so they are given by the first edges
+    # of dendrogram.
+    def _dendrogram(self, dests, costs):
+        dests = np.asarray(dests, dtype=int)
+        dests_num = len(dests)
+        dists = np.asarray(costs)[np.ix_(dests, dests)]
+        dists = (dists + dists.T) / 2
+
+        # Prim's algorithm, nearest[i] is the nearest vertex of tree to i.
+        in_tree = np.zeros(dests_num, dtype=bool)
+        nearest = np.zeros(dests_num, dtype=int)
+        best = np.full(dests_num, np.inf)
+        edges = list()
+        current = 0
+        for _ in range(dests_num - 1):
+            in_tree[current] = True
+            closer = dists[current] < best
+            best[closer] = dists[current][closer]
+            nearest[closer] = current
+            best[in_tree] = np.inf
+            current = int(np.argmin(best))
+            edges.append((nearest[current], current))
+
+        edges = np.array(edges, dtype=int).reshape(-1, 2)
+        edge_dists = dists[edges[:, 0], edges[:, 1]]
+        order = np.argsort(edge_dists, kind='stable')
+        return (edge_dists[order], dests[edges[order, 0]], dests[edges[order, 1]])
+
+    # Returns dendrogram of subset of dests, which is a cluster found with dendrogram.
+    def _sub_dendrogram(self, dendrogram, dests):
+        (dists, first, second) = dendrogram
+        inside = np.isin(first, dests) & np.isin(second, dests)
+        return (dists[inside], first[inside], second[inside])
+
+    # Returns number of clusters found by dbscan with min_size = 1 and given radius.
+    def _clusters_num(self, dests, dendrogram, radius):
+        return len(dests) - np.searchsorted(dendrogram[0], radius, side='right')
+
+    # Returns clusters found by dbscan with min_size = 1 and given radius, ordered by
+    # their first dest in dests. Clusters are merged with union-find.
+    def _dendrogram_clusters(self, dests, dendrogram, radius):
+        (dists, first, second) = dendrogram
+        merges = np.searchsorted(dists, radius, side='right')
+
+        parent = {dest: dest for dest in dests}
+        def find(dest):
+            while parent[dest] != dest:
+                parent[dest] = parent[parent[dest]]
+                dest = parent[dest]
+            return dest
+
+        for (a, b) in zip(first[:merges].tolist(), second[:merges].tolist()):
+            parent[find(a)] = find(b)
+
+        clusters = dict()
         for dest in dests:
-            if (costs[source][dest] + costs[dest][source]) / 2 <= radius:
-                result.append(dest)
-        return result
-
-    # Standard dbscan clustering dests.
-    # Returns list of clusters.
-    def _dbscan(self, dests, costs, radius, min_size):
-        clusters_num = -1
-
-        states = dict()
-        # Undifined cluster.
-        for d in dests:
-            states[d] = -2
-
-        for d in dests:
-            neighbours = self._range_query(dests, costs, d, radius)
-            if len(neighbours) < min_size:
-                states[d] = -1
-
-        for dest in dests:
-            if states[dest] != -2:
-                continue
-
-            clusters_num += 1
-            q = Queue()
-            q.put(dest)
-
-            while not q.empty():
-                dest2 = q.get()
-                states[dest2] = clusters_num
-                neighbours = self._range_query(dests, costs, dest2, radius)
-                for v in neighbours:
-                    if states[v] == -2:
-                        q.put(v)
-
-        for dest in dests: 
-            if states[dest] == -1:
-                min_dist = self.max_dist
-                best_neighbour = -1
-                for d in dests:
-                    if states[d] != -1:
-                        if costs[d][dest] < min_dist:
-                            best_neighbour = d
-                            min_dist = costs[d][dest]
-                if best_neighbour == -1:
-                    clusters_num += 1
-                    states[dest] = clusters_num
-                else:
-                    states[dest] = states[best_neighbour]
-
-        clusters = list()
-        for i in range(clusters_num + 1):
-            clusters.append(list())
-        for dest in dests:
-            cl = states[dest]
-            clusters[cl].append(dest)
-
-        return clusters
+            clusters.setdefault(find(dest), list()).append(dest)
+        return list(clusters.values())
 
     # Recursive dbscan. Returns list of clusters.
     # dests - set that need to be clustered.
@@ -145,9 +207,16 @@ class DBScanSolver(VRPSolver):
     # have at most max_len elements.
     # max_weight - maximum sum of deliveries' weights of a cluster. It is guaranteed that every cluster will
     # have at most max_weight sum of weights.
+    # dendrogram - dendrogram of dests (see _dendrogram), computed if it isn't given.
+    # Dbscan with min_size = 1 is used, so number of clusters for every radius is
+    # taken from dendrogram and dbscan doesn't have to be run.
     def _recursive_dbscan(self, dests, costs, min_radius, max_radius,
-                          clusters_num, max_len, max_weight):
+                          clusters_num, max_len, max_weight, dendrogram = None):
         best_res = [[d] for d in dests]
+        best_len = len(best_res)
+        best_radius = None
+        if dendrogram is None:
+            dendrogram = self._dendrogram(dests, costs)
 
         min_r = min_radius
         max_r = max_radius
@@ -157,14 +226,18 @@ class DBScanSolver(VRPSolver):
         while min_r + 1 < max_r:
             curr_r = (min_r + max_r) / 2
 
-            clusters = self._dbscan(dests, costs, curr_r, 1)
+            curr_clusters_num = self._clusters_num(dests, dendrogram, curr_r)
 
-            if len(clusters) < clusters_num:
+            if curr_clusters_num < clusters_num:
                 max_r = curr_r
             else:
                 min_r = curr_r
-                if len(clusters) < len(best_res):
-                    best_res = clusters
+                if curr_clusters_num < best_len:
+                    best_len = curr_clusters_num
+                    best_radius = curr_r
+
+        if best_radius is not None:
+            best_res = self._dendrogram_clusters(dests, dendrogram, best_radius)
 
         # Recursive dbscan on clusters with too many elements. 
         for cluster in best_res:
@@ -174,7 +247,8 @@ class DBScanSolver(VRPSolver):
             if len(cluster) > max_len or weight > max_weight:
                 best_res.remove(cluster)
                 best_res += self._recursive_dbscan(cluster, costs, 0., self.max_dist, 2,
-                                                   max_len, max_weight)
+                                                   max_len, max_weight,
+                                                   self._sub_dendrogram(dendrogram, cluster))
 
         # Removing singleton clusters while they are and there is more than clusters_num clusters.
         if self.anti_noiser:
@@ -217,7 +291,44 @@ class DBScanSolver(VRPSolver):
 
         return best_res
 
-    def solve(self, only_one_const, order_const, solver_type = 'cpu'):
+    # Solves TSP problem for every cluster with FullQuboSolver and returns routes in the
+    # same order. Clusters are solved as compact subproblems (see VRPProblem.get_subproblem),
+    # in parallel if max_workers > 1. Subproblems are created by workers, process workers
+    # get problem in shared memory (see VRPProblem.share), so costs aren't pickled.
+    def _solve_clusters(self, clusters, only_one_const, order_const, solver_type,
+                        first_source = True, last_source = True):
+        capacities = [self.problem.capacities[0]]
+        config = DWaveSolvers.solvers_config.get(solver_type, {})
+
+        executor = None
+        if self.max_workers > 1 and len(clusters) > 1:
+            executor = self.executor
+            if executor is None:
+                executor = 'thread' if solver_type in DWaveSolvers.thread_local_solvers else 'process'
+        problem = self.problem.share() if executor == 'process' else self.problem
+
+        tasks = list()
+        for (i, cluster) in enumerate(clusters):
+            seed = None if self.seed is None else self.seed + i
+            tasks.append((problem, cluster, capacities, first_source, last_source,
+                          only_one_const, order_const, solver_type, seed, config))
+
+        if executor is None:
+            solutions = [_solve_cluster(task) for task in tasks]
+        else:
+            pool_type = ThreadPoolExecutor if executor == 'thread' else ProcessPoolExecutor
+            try:
+                with pool_type(max_workers = self.max_workers) as pool:
+                    solutions = list(pool.map(_solve_cluster, tasks))
+            finally:
+                if problem is not self.problem:
+                    problem.release()
+
+        # Mapping local ids of subproblems to ids of problem.
+        return [[([self.problem.source] + cluster)[node] for node in solution.solution[0]]
+                for (solution, cluster) in zip(solutions, clusters)]
+
+    def _solve(self, only_one_const, order_const, solver_type = 'cpu'):
         problem = self.problem
         dests = problem.dests
         costs = problem.costs
@@ -234,25 +345,16 @@ class DBScanSolver(VRPSolver):
 
         # If we have as much small clusters as vehicles, we can solve TSP for every cluster.
         if len(clusters) == vehicles:
-            result = list()
-            for cluster in clusters:
-                new_problem = VRPProblem(sources, costs, [capacities[0]], cluster, weights)
-                solver = FullQuboSolver(new_problem)
-                solution = solver.solve(only_one_const, order_const,
-                                    solver_type = solver_type).solution[0]
-                result.append(solution)
+            result = self._solve_clusters(clusters, only_one_const, order_const, solver_type)
             return VRPSolution(problem, None, None, result)
 
         solutions = list()
         solutions.append(VRPSolution(problem, None, None, [[0]]))
 
         # Solving TSP for every cluster.
-        for cluster in clusters:
-            new_problem = VRPProblem(sources, costs, [capacities[0]], cluster, weights,
-                                 first_source = False, last_source = False)
-            solver = FullQuboSolver(new_problem)
-            solution = solver.solve(only_one_const, order_const, solver_type = solver_type)
-            solutions.append(solution)
+        routes = self._solve_clusters(clusters, only_one_const, order_const, solver_type,
+                                      first_source = False, last_source = False)
+        solutions += [VRPSolution(problem, None, None, [route]) for route in routes]
 
         # Creating smaller instance of problem for DBScanSolver.
         clusters_num = len(clusters) + 1
@@ -273,7 +375,9 @@ class DBScanSolver(VRPSolver):
                 new_weights[i] += weights[dest]
 
         new_problem = VRPProblem(sources, new_costs, capacities, new_dests, new_weights)
-        solver = DBScanSolver(new_problem)
+        seed = None if self.seed is None else self.seed + len(clusters)
+        solver = DBScanSolver(new_problem, max_workers = self.max_workers,
+                              executor = self.executor, seed = seed)
         compressed_solution = solver.solve(only_one_const, order_const, 
                             solver_type = solver_type).solution
 
@@ -290,95 +394,206 @@ class DBScanSolver(VRPSolver):
 # Solver uses some solver to generate TSP Solution and tries to make VRP solution from it.
 # Attributes : solver - VRPSolver object. DBScanSolver is recomended.
 # random - number of permutations of vehicles that will be generate. 
+# split - 'random' if solution is divided for random permutations of vehicles, 'exact' if
+# the best division for all orders of vehicles should be found (random isn't used then).
+# Exact division has a state for every number of used vehicles of every capacity, so if
+# there are more than max_states such states, random division is used instead.
 class SolutionPartitioningSolver(VRPSolver):
 
-    def __init__(self, problem, solver, random = 100):
+    def __init__(self, problem, solver, random = 100, split = 'random', max_states = 1000):
+        if split not in ('random', 'exact'):
+            raise ValueError("split should be 'random' or 'exact', not " + repr(split) + '.')
         self.problem = problem
         self.solver = solver
         self.random = random
+        self.split = split
+        self.max_states = max_states
         self.inf = 2 * sum(map(sum, problem.costs))
+
+    # Returns array with costs of dividing solution between i-th and (i + 1)-th element.
+    def _div_costs(self, solution):
+        costs = np.asarray(self.problem.costs)
+        route = np.asarray(solution, dtype=int)
+        div_costs = np.zeros(len(solution))
+        if len(solution) > 2:
+            d1 = route[1:-1]
+            d2 = route[2:]
+            div_costs[1:-1] = costs[d1, 0] + costs[0, d2] - costs[d1, d2]
+        return div_costs
+
+    # Returns path of vehicle serving part (prev, pointer] of solution.
+    def _part(self, solution, prev, pointer):
+        if prev == pointer:
+            return []
+        lis = solution[(prev + 1):(pointer + 1)]
+        if prev != -1:
+            lis = [0] + lis
+        if pointer != len(solution) - 1:
+            lis = lis + [0]
+        return lis
     
-    # Divides TSP solution to continous parts that will be correct VRP solution.
-    def _divide_solution_greedy_dp(self, solution):
-        problem = self.problem
-        capacities = problem.capacities
-        costs = problem.costs
-        weights = problem.weights
+    # Divides TSP solution for every row of capacities (orders of vehicles' capacities)
+    # at once. Returns list of divisions (lists of vehicles' paths).
+    # dp[k][i][j] is the lowest cost of dividing first i + 1 elements of solution between
+    # first j vehicles of k-th order. Vehicle j serves part (p, i] of solution if sum of its
+    # weights doesn't exceed capacity, so p is in window [lo, i - 1] found with prefix sums
+    # of weights, and whole layer of dp is computed with range minimum queries.
+    def _divide_solution_batch(self, solution, capacities):
+        weights = np.asarray(self.problem.weights)
 
         dests = len(solution)
-        vehicles = len(capacities)
-        div_costs = np.zeros(dests)
-        for i in range(1, dests - 1):
-            d1 = solution[i]
-            d2 = solution[i+1]
-            div_costs[i] = costs[d1][0] + costs[0][d2] - costs[d1][d2]
-
-        dp = np.zeros((dests, vehicles + 1), dtype=float)
-        prev_state = np.zeros((dests, vehicles + 1), dtype=int)
-
-        for i in range(dests):
-            if i != 0:
-                dp[i][0] = self.inf
-            for j in range(1, vehicles + 1):
-                cap = capacities[j-1]
-                pointer = i
-                dp[i][j] = dp[i][j-1]
-                prev_state[i][j] = i
-                while pointer > 0 and cap >= weights[solution[pointer]]:
-                    pointer -= 1
-                    new_cost = div_costs[pointer] + dp[pointer][j-1]
-                    if new_cost < dp[i][j]:
-                        dp[i][j] = new_cost
-                        prev_state[i][j] = pointer
-                    cap -= weights[solution[pointer + 1]]
-
-        new_solution = []
-        pointer = dests - 1
-        for j in reversed(range(1, vehicles + 1)):
-            prev = prev_state[pointer][j]
-            if prev != pointer:
-                lis = solution[(prev + 1):(pointer + 1)]
-                if prev != -1:
-                    lis = [0] + lis
-                if pointer != dests - 1:
-                    lis = lis + [0]
-                new_solution.append(lis)
-            else:
-                new_solution.append([])
-            pointer = prev
-        
-        new_solution.reverse()
-        return VRPSolution(problem, None, None, new_solution)
-
-    # Creates random permutations of vehicles and using _divide_solution_greedy for
-    # each of them. 
+        (orders, vehicles) = capacities.shape
+        div_costs = self._div_costs(solution)
+        prefix = np.cumsum(weights[np.asarray(solution, dtype=int)])
+        positions = np.arange(dests)
+
+        dp = np.zeros((orders, dests, vehicles + 1), dtype=float)
+        prev_state = np.zeros((orders, dests, vehicles + 1), dtype=int)
+        dp[:, 1:, 0] = self.inf
+
+        for j in range(1, vehicles + 1):
+            caps = capacities[:, j-1]
+            lo = np.searchsorted(prefix, prefix[None, :] - caps[:, None], side='left')
+            values = div_costs[None, :] + dp[:, :, j-1]
+            best = _range_argmin(_range_min_table(values), values, lo,
+                                 np.broadcast_to(positions - 1, lo.shape))
+
+            best_values = np.take_along_axis(values, np.maximum(best, 0), axis=1)
+            better = (best >= 0) & (best_values < dp[:, :, j-1])
+            dp[:, :, j] = np.where(better, best_values, dp[:, :, j-1])
+            prev_state[:, :, j] = np.where(better, best, positions)
+
+        divisions = list()
+        for k in range(orders):
+            new_solution = []
+            pointer = dests - 1
+            for j in reversed(range(1, vehicles + 1)):
+                prev = prev_state[k][pointer][j]
+                new_solution.append(self._part(solution, prev, pointer))
+                pointer = prev
+
+            new_solution.reverse()
+            divisions.append(new_solution)
+
+        return divisions
+
+    # Creates random permutations of vehicles and divides solution for each of them.
+    # Permutations giving the same order of capacities give the same division, so every
+    # order is evaluated once (with the first permutation giving it) and all orders are
+    # divided in one batch. Problem isn't changed.
     # random - number of permutations.
     def _divide_solution_random(self, solution):
         random = self.random
-        capacities = self.problem.capacities.copy()
+        capacities = np.asarray(self.problem.capacities)
         vehicles = len(capacities)
 
+        perms = dict()
+        for i in range(random):
+            perm = np.random.permutation(vehicles)
+            perms.setdefault(tuple(capacities[perm].tolist()), perm)
+
         new_solution = None
         best_cost = self.inf
+        if len(perms) == 0:
+            return new_solution
 
-        for i in range(random):
-            perm = np.random.permutation(vehicles)
-            inv = [list(perm).index(j) for j in range(vehicles)]
-            self.problem.capacities = [capacities[j] for j in perm]
+        orders = np.array(list(perms.keys())).reshape(len(perms), vehicles)
+        divisions = self._divide_solution_batch(solution, orders)
 
-            new_sol = self._divide_solution_greedy_dp(solution)
+        for (division, perm) in zip(divisions, perms.values()):
+            inv = np.argsort(perm)
+            new_sol = VRPSolution(self.problem, None, None, [division[j] for j in inv])
             new_cost = new_sol.total_cost()
 
             if new_cost < best_cost and new_sol.check():
                 best_cost = new_cost
                 new_solution = new_sol
-                new_solution.solution = [new_sol.solution[j] for j in inv]
 
-            self.problem.capacities = capacities
+        return new_solution
+
+    # Returns number of states of dp in _divide_solution_exact.
+    def _exact_states(self):
+        capacities = list(self.problem.capacities)
+        states = 1
+        for cap in set(capacities):
+            states *= capacities.count(cap) + 1
+        return states
+
+    # Finds the best division of solution for all orders of vehicles. Vehicles with the
+    # same capacity are interchangeable, so state of dp is number of used vehicles of
+    # every capacity (key) and dp[key][i] is the lowest cost of dividing first i + 1
+    # elements of solution between these vehicles. Transitions for all keys with the same
+    # number of vehicles are computed at once like in _divide_solution_batch.
+    # Number of keys is product of (number of vehicles + 1) for every capacity, so it is
+    # number of vehicles + 1 if all capacities are the same.
+    # Returns None if there is no correct division.
+    def _divide_solution_exact(self, solution):
+        problem = self.problem
+        capacities = list(problem.capacities)
+        weights = np.asarray(problem.weights)
 
+        dests = len(solution)
+        div_costs = self._div_costs(solution)
+        prefix = np.cumsum(weights[np.asarray(solution, dtype=int)])
+        positions = np.arange(dests)
+
+        types = sorted(set(capacities))
+        counts = [capacities.count(cap) for cap in types]
+        def step(key, t, diff):
+            return key[:t] + (key[t] + diff,) + key[t+1:]
+
+        start = tuple(0 for _ in types)
+        dp = {start: np.where(positions == 0, 0., self.inf)}
+        prev_state = dict()
+        keys = [start]
+
+        for _ in range(len(capacities)):
+            keys = sorted({step(key, t, 1) for key in keys for t in range(len(types))
+                           if key[t] < counts[t]})
+            transitions = [(key, t) for key in keys for t in range(len(types)) if key[t] > 0]
+
+            last = np.array([dp[step(key, t, -1)] for (key, t) in transitions])
+            caps = np.array([types[t] for (_, t) in transitions])
+            lo = np.searchsorted(prefix, prefix[None, :] - caps[:, None], side='left')
+            values = div_costs[None, :] + last
+            best = _range_argmin(_range_min_table(values), values, lo,
+                                 np.broadcast_to(positions - 1, lo.shape))
+
+            best_values = np.take_along_axis(values, np.maximum(best, 0), axis=1)
+            better = (best >= 0) & (best_values < last)
+            new_dp = np.where(better, best_values, last)
+            new_prev = np.where(better, best, positions)
+
+            # Choosing the best transition for every key.
+            row = 0
+            for key in keys:
+                key_types = np.array([t for t in range(len(types)) if key[t] > 0])
+                rows = slice(row, row + len(key_types))
+                chosen = np.argmin(new_dp[rows], axis=0)
+                dp[key] = new_dp[rows][chosen, positions]
+                prev_state[key] = (new_prev[rows][chosen, positions], key_types[chosen])
+                row += len(key_types)
+
+        key = tuple(counts)
+        if dp[key][dests - 1] >= self.inf:
+            return None
+
+        parts = [list() for _ in types]
+        pointer = dests - 1
+        while key != start:
+            (prev, key_types) = prev_state[key]
+            t = key_types[pointer]
+            parts[t].append(self._part(solution, prev[pointer], pointer))
+            pointer = prev[pointer]
+            key = step(key, t, -1)
+
+        new_solution = [parts[types.index(cap)].pop() for cap in capacities]
+        new_solution = VRPSolution(problem, None, None, new_solution)
+        if not new_solution.check():
+            return None
         return new_solution
 
-    def solve(self, only_one_const, order_const, solver_type = 'cpu'):
+    def _solve(self, only_one_const, order_const, solver_type = 'cpu'):
         problem = self.problem
         capacity = 0
         weights = problem.weights
@@ -401,4 +616,56 @@ class SolutionPartitioningSolver(VRPSolver):
         solution = solver.solve(only_one_const, order_const, solver_type = solver_type)
 
         sol = solution.solution[0]
+        if self.split == 'exact' and self._exact_states() <= self.max_states:
+            return self._divide_solution_exact(sol)
         return self._divide_solution_random(sol)
+
+# Solves TSP problem of one cluster of DBScanSolver. It is module function, so it can be
+# run in other process. Task contains problem, cluster, capacities, first_source,
+# last_source (parameters of subproblem), only_one_const, order_const, solver_type, seed
+# and configuration of solver, which is applied if process has different one.
+def _solve_cluster(task):
+    (problem, cluster, capacities, first_source, last_source,
+     only_one_const, order_const, solver_type, seed, config) = task
+    if DWaveSolvers.solvers_config.get(solver_type, {}) != config:
+        DWaveSolvers.configure_solver(solver_type, **config)
+    (problem, _) = problem.get_subproblem(cluster, capacities, first_source, last_source)
+    solver = FullQuboSolver(problem, seed = seed)
+    return solver.solve(only_one_const, order_const, solver_type = solver_type)
+
+# Returns sparse table for range minimum queries on every row of values : table[k][r][i]
+# is index of minimum of values[r][i:i + 2^k], the last one if there are many of them.
+def _range_min_table(values):
+    length = values.shape[1]
+    table = [np.broadcast_to(np.arange(length), values.shape)]
+    size = 1
+    while 2 * size <= length:
+        last = table[-1]
+        left = last[:, :length - 2 * size + 1]
+        right = last[:, size:length - size + 1]
+        right_better = (np.take_along_axis(values, right, axis=1) <=
+                        np.take_along_axis(values, left, axis=1))
+        table.append(np.where(right_better, right, left))
+        size *= 2
+    return table
+
+# Returns index of minimum of values[r][left[r][i]:right[r][i] + 1] for every r and i,
+# the last one if there are many of them, or -1 if range is empty.
+def _range_argmin(table, values, left, right):
+    result = np.full(left.shape, -1, dtype=int)
+    valid = left <= right
+    rows = np.nonzero(valid)[0]
+    (left, right) = (left[valid], right[valid])
+    if len(left) == 0:
+        return result
+
+    levels = np.log2(right - left + 1).astype(int)
+    first = np.zeros(len(left), dtype=int)
+    second = np.zeros(len(left), dtype=int)
+    for k in np.unique(levels):
+        at = levels == k
+        first[at] = table[k][rows[at], left[at]]
+        second[at] = table[k][rows[at], right[at] - (1 << k) + 1]
+
+    result[valid] = np.where(values[rows, second] <= values[rows, first], second, first)
+    return result
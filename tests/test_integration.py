@@ -14,10 +14,26 @@
 
 import subprocess
 import unittest
+import tempfile
+import pickle
+import itertools
 import os
 import sys
 
+import numpy as np
+import dimod
+
 project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(project_dir, 'src'))
+
+from multiprocessing import shared_memory
+from input import read_test, read_full_test, create_binary_test, read_binary_test
+from input import read_csr_graph, cached_terminal_distances
+from qubo_helper import Qubo
+from local_samplers import AnnealingSampler, TabuSampler
+from vrp_problem import VRPProblem
+from vrp_solution import VRPSolution
+from vrp_solvers import DBScanSolver, SolutionPartitioningSolver
 
 class IntegrationTests(unittest.TestCase):
     """Run all example files with small problems to make sure there aren't any crashes."""
@@ -73,5 +89,292 @@ class IntegrationTests(unittest.TestCase):
             num_total_costs = output.count("TOTAL COST : ")
             self.assertEqual(num_total_costs, 2)
 
+    def test_local_samplers(self):
+        output = self.get_output('examples/LocalSamplers.py')
+
+        with self.subTest(msg="Verify if output contains a solution for every sampler tested. \n"):
+            num_solutions = output.count("SOLUTION : ")
+            self.assertEqual(num_solutions, 3)
+            self.assertNotIn("SOLVER HASN'T FIND SOLUTION.", output)
+        with self.subTest(msg="Verify if output contains a total cost for every sampler tested. \n"):
+            num_total_costs = output.count("TOTAL COST : ")
+            self.assertEqual(num_total_costs, 3)
+
+class ClassicalTests(unittest.TestCase):
+    """Check classical parts of solvers on small problems against simple implementations."""
+    def test_cached_terminal_distances(self):
+        graph_path = os.path.join(project_dir, 'graphs/medium.csv')
+        nodes = list(read_csr_graph(graph_path)[0])
+        terminals = nodes[:40]
+        shifted = nodes[20:60]
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            first = cached_terminal_distances(graph_path, terminals, cache_dir)
+            again = cached_terminal_distances(graph_path, terminals, cache_dir)
+            partial = cached_terminal_distances(graph_path, shifted, cache_dir)
+
+            expected = cached_terminal_distances(graph_path, terminals)
+            np.testing.assert_array_equal(first, expected)
+            np.testing.assert_array_equal(again, expected)
+            np.testing.assert_array_equal(partial,
+                                          cached_terminal_distances(graph_path, shifted))
+            del first, again, partial
+
+    def test_shared_problem(self):
+        graph_path = os.path.join(project_dir, 'graphs/medium.csv')
+        path = os.path.join(project_dir, 'tests/vrp/medium_graph1.test')
+        problem = read_full_test(path, graph_path, capacity = False)
+
+        shared = problem.share()
+        names = [name for (name, _, _) in shared._handles.values()]
+        data = pickle.dumps(shared)
+        self.assertLess(len(data), np.asarray(problem.costs).nbytes)
+
+        attached = pickle.loads(data)
+        np.testing.assert_array_equal(attached.costs, problem.costs)
+        np.testing.assert_array_equal(attached.weights, problem.weights)
+        attached.release()
+        np.testing.assert_array_equal(shared.costs, problem.costs)
+        shared.release()
+        np.testing.assert_array_equal(shared.costs, problem.costs)
+
+        for name in names:
+            with self.assertRaises(FileNotFoundError):
+                shared_memory.SharedMemory(name = name)
+
+        solutions = list()
+        for (max_workers, executor) in [(1, None), (2, 'process'), (2, 'thread')]:
+            solver = DBScanSolver(problem, max_len = 10, max_workers = max_workers,
+                                  executor = executor, seed = 0)
+            solution = solver.solve(10000000., 1., solver_type = 'sa')
+            self.assertTrue(solution.check())
+            solutions.append(solution.solution)
+        self.assertEqual(solutions[1], solutions[0])
+        self.assertEqual(solutions[2], solutions[0])
+
+    def test_spin_samples(self):
+        bqm = dimod.BinaryQuadraticModel({'a' : 1., 'b' : -1., 'c' : 0.5},
+                                         {('a', 'b') : -1., ('b', 'c') : 2.}, 0.3, dimod.SPIN)
+        for sampler in [AnnealingSampler(seed = 0), TabuSampler(seed = 0)]:
+            sample_set = sampler.sample(bqm)
+            self.assertIs(sample_set.vartype, dimod.SPIN)
+            for (sample, energy) in sample_set.data(['sample', 'energy']):
+                self.assertAlmostEqual(bqm.energy(sample), energy)
+
+    def test_qubo_template(self):
+        rng = np.random.default_rng(0)
+        for (first_source, last_source) in itertools.product([True, False], repeat = 2):
+            costs = rng.integers(1, 50, (7, 7))
+            weights = rng.integers(1, 5, 7).tolist()
+            problem = VRPProblem([0, 1], costs, [10, 7, 12], [2, 3, 4, 5, 6], weights,
+                                 first_source, last_source)
+            limits = [(1, 3), (0, 2), (2, 2)]
+
+            for capacity_const in [0., 3.]:
+                qubo = problem.get_qubo_with_both_limits(limits, 100., 2., capacity_const)
+                fields = self._fields(qubo)
+                expected = self._fields(self._reference_qubo(problem, limits, 100., 2.,
+                                                             capacity_const))
+                self.assertEqual(fields.keys(), expected.keys())
+                for (field, value) in expected.items():
+                    self.assertAlmostEqual(fields[field], value)
+
+    # Returns dict of qubo with fields (a, b) and (b, a) stored as (min(a, b), max(a, b)).
+    def _fields(self, qubo):
+        fields = dict()
+        for (field, value) in qubo.get_dict().items():
+            field = tuple(sorted(field))
+            fields[field] = fields.get(field, 0.) + value
+        return fields
+
+    # Returns qubo with both limits merged from qubos of constraints, orders,
+    # first and last destinations and capacities of VRPProblem.
+    def _reference_qubo(self, problem, vehicle_limits, only_one_const, order_const,
+                        capacity_const):
+        steps = sum(r for (_, r) in vehicle_limits)
+        (dests, source, costs) = (problem.dests, problem.source, problem.costs)
+        dests_with_source = dests + [source]
+        qubo = Qubo()
+
+        for dest in dests:
+            qubo.add_only_one_constraint([(step, dest) for step in range(steps)], only_one_const)
+
+        start = 0
+        for (vehicle, (min_size, max_size)) in enumerate(vehicle_limits):
+            min_final = start + min_size - 1
+            max_final = start + max_size - 1
+
+            if min_size != 0:
+                for step in range(start, min_final + 1):
+                    qubo.add_only_one_constraint([(step, d) for d in dests], only_one_const)
+                qubo.merge_with(problem.get_order_qubo(start, min_final, dests, costs),
+                                1., order_const)
+            if max_size != min_size:
+                for step in range(min_final + 1, max_final + 1):
+                    qubo.add_only_one_constraint([(step, d) for d in dests_with_source],
+                                                 only_one_const)
+                qubo.merge_with(problem.get_order_qubo(min_final + 1, max_final,
+                                                       dests_with_source, costs),
+                                1., order_const)
+            if min_size != 0 and min_size != max_size:
+                for (d1, d2) in itertools.product(dests, dests_with_source):
+                    qubo.add(((min_final, d1), (min_final + 1, d2)), costs[d1][d2] * order_const)
+
+            if problem.first_source:
+                first = dests if min_size != 0 else dests_with_source
+                qubo.merge_with(problem.get_first_dest_qubo(start, first, costs, source),
+                                1., order_const)
+            if problem.last_source:
+                last = dests if max_size == min_size else dests_with_source
+                qubo.merge_with(problem.get_last_dest_qubo(max_final, last, costs, source),
+                                1., order_const)
+            if capacity_const != 0 and max_size != 0:
+                qubo.merge_with(problem.get_capacity_qubo(problem.capacities[vehicle],
+                                                          start, max_final),
+                                1., capacity_const)
+
+            start = max_final + 1
+
+        return qubo
+
+    def test_batch_split(self):
+        rng = np.random.default_rng(0)
+        for _ in range(200):
+            dests_num = int(rng.integers(1, 12))
+            costs = rng.integers(1, 50, (dests_num + 1, dests_num + 1))
+            weights = [0] + rng.integers(1, 5, dests_num).tolist()
+            vehicles = int(rng.integers(1, 5))
+            capacities = rng.integers(1, 10, (3, vehicles))
+            problem = VRPProblem([0], costs, capacities[0].tolist(),
+                                 list(range(1, dests_num + 1)), weights)
+            solver = SolutionPartitioningSolver(problem, None)
+            tour = [0] + rng.permutation(range(1, dests_num + 1)).tolist() + [0]
+
+            divisions = solver._divide_solution_batch(tour, capacities)
+            for (division, caps) in zip(divisions, capacities.tolist()):
+                expected = self._pointer_walk_split(problem, tour, caps)
+                if expected is not None:
+                    self.assertEqual(division, expected)
+
+    # Divides tour with dp walking back from every position while the part fits into
+    # capacity of vehicle. Returns None if there is no correct division.
+    def _pointer_walk_split(self, problem, tour, capacities):
+        (costs, weights) = (problem.costs, problem.weights)
+        dests = len(tour)
+        inf = float('inf')
+        div_costs = [0.] * dests
+        for i in range(1, dests - 1):
+            div_costs[i] = costs[tour[i]][0] + costs[0][tour[i+1]] - costs[tour[i]][tour[i+1]]
+
+        dp = [[0.] + [inf] * (dests - 1)]
+        prev_state = [None]
+        for cap in capacities:
+            layer = list(dp[-1])
+            prev = list(range(dests))
+            for i in range(dests):
+                (pointer, left) = (i, cap)
+                while pointer > 0 and left >= weights[tour[pointer]]:
+                    left -= weights[tour[pointer]]
+                    pointer -= 1
+                    if div_costs[pointer] + dp[-1][pointer] < layer[i]:
+                        layer[i] = div_costs[pointer] + dp[-1][pointer]
+                        prev[i] = pointer
+            dp.append(layer)
+            prev_state.append(prev)
+
+        if dp[-1][dests - 1] == inf:
+            return None
+
+        division = list()
+        pointer = dests - 1
+        for j in reversed(range(1, len(capacities) + 1)):
+            prev = prev_state[j][pointer]
+            part = list()
+            if prev != pointer:
+                part = tour[(prev + 1):(pointer + 1)]
+                part = [0] + part
+                if pointer != dests - 1:
+                    part = part + [0]
+            division.append(part)
+            pointer = prev
+        division.reverse()
+        return division
+
+    def test_exact_split(self):
+        rng = np.random.default_rng(0)
+        for _ in range(50):
+            dests_num = int(rng.integers(2, 9))
+            costs = rng.integers(1, 50, (dests_num + 1, dests_num + 1))
+            weights = [0] + rng.integers(1, 5, dests_num).tolist()
+            capacities = rng.choice([4, 6, 9], int(rng.integers(2, 5))).tolist()
+            problem = VRPProblem([0], costs, capacities, list(range(1, dests_num + 1)), weights)
+            solver = SolutionPartitioningSolver(problem, None, split = 'exact')
+            tour = [0] + rng.permutation(range(1, dests_num + 1)).tolist() + [0]
+
+            # The best division over all orders of vehicles.
+            best = None
+            for order in set(itertools.permutations(capacities)):
+                division = solver._divide_solution_batch(tour, np.array([order]))[0]
+                vehicles = sorted(range(len(capacities)), key = lambda i: capacities[i])
+                routes = [None] * len(capacities)
+                for j in sorted(range(len(order)), key = lambda j: order[j]):
+                    routes[vehicles.pop(0)] = division[j]
+                solution = VRPSolution(problem, None, None, routes)
+                if solution.check() and (best is None or solution.total_cost() < best):
+                    best = solution.total_cost()
+
+            exact = solver._divide_solution_exact(tour)
+            if best is None:
+                self.assertIsNone(exact)
+            else:
+                self.assertTrue(exact.check())
+                self.assertEqual(exact.total_cost(), best)
+
+    def test_exact_split_many_capacities(self):
+        path = os.path.join(project_dir, 'tests/cvrp/example_medium4.test')
+        problem = read_test(path, capacity = True)
+
+        with self.assertRaises(ValueError):
+            SolutionPartitioningSolver(problem, None, split = 'greedy')
+
+        # Capacities are almost all different, so random division is used.
+        solver = SolutionPartitioningSolver(problem, DBScanSolver(problem, seed = 0),
+                                            split = 'exact')
+        self.assertGreater(solver._exact_states(), solver.max_states)
+        solution = solver.solve(10000000., 1., solver_type = 'sa')
+        self.assertTrue(solution.check())
+
+    def test_polish(self):
+        graph_path = os.path.join(project_dir, 'graphs/medium.csv')
+        path = os.path.join(project_dir, 'tests/vrp/medium_graph1.test')
+        problem = read_full_test(path, graph_path, capacity = False)
+
+        solver = DBScanSolver(problem, max_len = 10, seed = 0)
+        solution = solver.solve(10000000., 1., solver_type = 'sa')
+        polished = solver.solve(10000000., 1., solver_type = 'sa', polish = True)
+        self.assertTrue(polished.check())
+        self.assertLessEqual(polished.total_cost(), solution.total_cost())
+
+    def test_binary_test(self):
+        graph_path = os.path.join(project_dir, 'graphs/small.csv')
+        vrp_path = os.path.join(project_dir, 'tests/vrp/small_graph1.test')
+        cvrp_path = os.path.join(project_dir, 'tests/cvrp/example1.test')
+
+        with tempfile.TemporaryDirectory() as out_dir:
+            out_path = os.path.join(out_dir, 'test.bin')
+            for (capacity, in_path, graph, problem) in [
+                    (True, cvrp_path, None, read_test(cvrp_path, capacity = True)),
+                    (False, vrp_path, graph_path,
+                     read_full_test(vrp_path, graph_path, capacity = False))]:
+                create_binary_test(in_path, out_path, capacity, graph)
+                binary = read_binary_test(out_path)
+
+                self.assertEqual(binary.sources, problem.sources)
+                self.assertEqual(binary.dests, problem.dests)
+                self.assertEqual(list(binary.capacities), list(problem.capacities))
+                np.testing.assert_array_equal(binary.costs, problem.costs)
+                np.testing.assert_array_equal(binary.weights, problem.weights)
+                del binary
+
 if __name__ == '__main__':
     unittest.main()